@@ -0,0 +1,88 @@
+import math
+import numpy as np
+import metrics
+import util
+
+CONF_BINS = 50
+NN_BINS = 50
+NN_RANGE_PERCENTILE = 99  # nearest neighbor histograms end at this percentile so a few isolated picks don't squash it
+DENSITY_BINS = 64  # density heatmap cells along the longer micrograph edge
+
+
+# KD-tree over the box centers of a coordinate table (scipy is imported here, it's only needed for the analytics
+# panel and slow to import)
+@metrics.instrument
+def build_tree(df):
+    from scipy.spatial import cKDTree
+    return cKDTree(np.column_stack([df['x'].to_numpy(), df['y'].to_numpy()]))
+
+
+# nearest neighbors in tree of all points of points_tree (arguments as for cKDTree.query), queried in the leaf
+# order of points_tree so consecutive queries visit the same nodes (about twice as fast as in table order), on
+# all cores, and returned in table order
+def query_nearest(tree, points_tree, **kwargs):
+    order = points_tree.indices
+    dist, idx = tree.query(points_tree.data[order], workers=-1, **kwargs)
+    table_dist, table_idx = np.empty_like(dist), np.empty_like(idx)
+    table_dist[order], table_idx[order] = dist, idx
+    return table_dist, table_idx
+
+
+# histogram of confidences (boxes without confidence are left out) as (counts, bin edges)
+def get_conf_histogram(df, bins=CONF_BINS):
+    conf = df['conf'].to_numpy()
+    return np.histogram(conf[conf != util.NO_CONF_VAL], bins=bins, range=(0, 1))
+
+
+# distance from every box center to its nearest neighbor, all queried from the tree at once
+def get_nn_distances(tree):
+    if tree.n < 2:
+        return np.empty(0)
+    return query_nearest(tree, tree, k=2)[0][:, 1]  # the nearest point to each center is itself
+
+
+# pick counts in square cells over the micrograph (shape (h, w) in px, or the extent of the boxes if None)
+# as (counts indexed [row, col], cell edge in px)
+def get_density(df, shape=None, bins=DENSITY_BINS):
+    x, y = df['x'].to_numpy(), df['y'].to_numpy()
+    if shape is None:
+        shape = (y.max() + 1, x.max() + 1) if len(x) else (1, 1)
+    h, w = shape
+    cell_px = max(h, w) / bins
+    n_rows, n_cols = max(int(math.ceil(h / cell_px)), 1), max(int(math.ceil(w / cell_px)), 1)
+    counts, _, _ = np.histogram2d(y, x, bins=[n_rows, n_cols], range=[[0, n_rows * cell_px], [0, n_cols * cell_px]])
+    return counts.astype(np.int64), cell_px
+
+
+# confidence histogram, nearest neighbor distance histogram and density heatmap of a coordinate table
+# (tree is its build_tree) as plain lists, ready to be cached and plotted
+@metrics.instrument
+def get_file_stats(df, tree, shape=None):
+    conf_counts, conf_edges = get_conf_histogram(df)
+    nn = get_nn_distances(tree)
+    nn_max = max(np.percentile(nn, NN_RANGE_PERCENTILE), 1) if len(nn) else 1
+    nn_counts, nn_edges = np.histogram(np.minimum(nn, nn_max), bins=NN_BINS, range=(0, nn_max))
+    density, cell_px = get_density(df, shape)
+    return {'count': len(df.index), 'conf_counts': conf_counts.tolist(), 'conf_edges': conf_edges.tolist(),
+            'nn_counts': nn_counts.tolist(), 'nn_edges': nn_edges.tolist(),
+            'nn_median': float(np.median(nn)) if len(nn) else None, 'density': density.tolist(), 'cell_px': cell_px}
+
+
+# agreement of two pickers given the KD-trees of their box centers: picks are matched one to one where they are
+# each other's nearest neighbor within radius px, and for each picker the share of its picks with any pick of
+# the other within radius is reported too
+@metrics.instrument
+def get_agreement(tree_a, tree_b, radius):
+    n_a, n_b = tree_a.n, tree_b.n
+    if n_a == 0 or n_b == 0:
+        return {'n_a': n_a, 'n_b': n_b, 'matched': 0, 'a_near_b': 0.0, 'b_near_a': 0.0, 'jaccard': 0.0,
+                'median_offset': None}
+    dist_ab, nn_ab = query_nearest(tree_b, tree_a, distance_upper_bound=radius)  # inf/n_b where there's none
+    dist_ba, nn_ba = query_nearest(tree_a, tree_b, distance_upper_bound=radius)
+    near_ab, near_ba = np.isfinite(dist_ab), np.isfinite(dist_ba)
+    a_idx = np.flatnonzero(near_ab)
+    mutual = nn_ba[nn_ab[a_idx]] == a_idx
+    matched = int(mutual.sum())
+    return {'n_a': n_a, 'n_b': n_b, 'matched': matched, 'a_near_b': float(near_ab.mean()),
+            'b_near_a': float(near_ba.mean()), 'jaccard': matched / (n_a + n_b - matched),
+            'median_offset': float(np.median(dist_ab[a_idx][mutual])) if matched else None}
@@ -1,41 +1,65 @@
-from dash.dependencies import Input, Output, State
+import dash
+from dash.dependencies import Input, Output, State, ClientsideFunction
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table as dt
 import dash_daq as daq
-import dash_auth as da
 import dash_uploader as du
-import plotly.express as px
+import flask
 import plotly.graph_objects as go
-import pandas as pd
-import base64
-from io import BytesIO, StringIO
-import mrcfile
+from plotly.subplots import make_subplots
+import functools
+import json
+import logging
+import math
 # from mrcfile import mrcinterpreter
 import os
 from pathlib import Path
-import hashlib
+import sys
 import uuid
 import util
+import tiles
+import contrast
+import binning
+import boxstore
+import spatial
+import jobs
+import metrics
+import session
+import storage
+import rendercache
 
 external_stylesheets = ['/assets/style.css']
 UPLOAD_ROOT = 'uploads'
+TABLE_PAGE_ROWS = 25  # coordinate table rows sent to the browser at a time
 
-try:  # check if we're running in a notebook (not defined outside of IPython)
-    get_ipython  # syntax warnings are fine here
+metrics.configure_logging()
+logger = logging.getLogger('mrc-viewer')  # Dash gives the logger named after this module its own handler
+
+if 'ipykernel' in sys.modules:  # imported from a notebook (app_nb.ipynb), runs inline at the end of this file
     from jupyter_dash import JupyterDash
     app = JupyterDash(__name__, external_stylesheets=external_stylesheets)
-except Exception:  # otherwise assume we're on a server
-    from dash import Dash
-    app = Dash(__name__, external_stylesheets=external_stylesheets)
+else:  # otherwise assume we're on a server
+    app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
     server = app.server  # for gunicorn deployment
-    is_heroku = os.environ.get('IS_HEROKU', None)  # detect Heroku deployment
-    if is_heroku:
-        collab_user = os.environ.get('COLLAB_USER', None)  # basic HTTP auth
-        collab_key = os.environ.get('COLLAB_SECRET', None)
-        auth = da.BasicAuth(app, {collab_user: collab_key})
+du.configure_upload(app, UPLOAD_ROOT)  # before auth, which only protects the routes that exist when it's set up
+
+auth = None
+is_heroku = os.environ.get('IS_HEROKU', None)  # detect Heroku deployment
+if is_heroku:
+    import dash_auth as da  # only needed here, and slow to import (it pulls in chart_studio and IPython)
+    collab_user = os.environ.get('COLLAB_USER', None)  # basic HTTP auth
+    collab_key = os.environ.get('COLLAB_SECRET', None)
+    auth = da.BasicAuth(app, {collab_user: collab_key})
+
+
+# routes added to the server below need the same auth as Dash's own (auth_wrapper drops the view's name, which
+# flask uses as the endpoint)
+def protect(view):
+    return functools.wraps(view)(auth.auth_wrapper(view)) if auth is not None else view
 
-du.configure_upload(app, UPLOAD_ROOT)
+
+metrics.instrument_dash(app)
 
 # cache = Cache(app.server, config={
 #     'CACHE_TYPE': 'filesystem',
@@ -59,7 +83,16 @@ manual_boxsize_warning = html.H6(
 # main layout
 def get_app_layout():
     return html.Div([
-        dcc.Store(id='boxfile-memory', data={'boxfile-counter': 0, 'boxfiles': {}, 'filenames': {}, 'filehashes': {}}),
+        dcc.Store(id='boxfile-memory', data={'boxfile-counter': 0, 'boxinfo': {}, 'filenames': {}, 'filehashes': {},
+                                                'viewport': None}),
+        dcc.Store(id='micrograph-memory', data={}),
+        dcc.Store(id='job-memory', data={}),
+        dcc.Store(id='graph-size', data=None),
+        dcc.Store(id='session-memory', data={}),
+        dcc.Store(id='overlay-arrays', data={}),
+        dcc.Store(id='overlay-groups', data=[]),
+        dcc.Store(id='overlay-filter-count', data=0),
+        dcc.Interval(id='job-poll', interval=1000, disabled=True),
         html.Div([
             html.Div([
                 html.H3('Particle Coordinates'),
@@ -182,6 +215,15 @@ def get_app_layout():
                         'display': 'flex',
                         'alignItems': 'center'
                     }),
+                    dcc.Checklist(
+                        id='live-filter',
+                        options=[{'label': ' Filter boxes live in the browser (no Apply needed)', 'value': 'live'}],
+                        value=['live'],
+                        style={
+                            'marginLeft': '20px',
+                            'marginTop': '10px'
+                        }
+                    ),
                     html.P(
                         'Applies to starred (*) coordinate files above.',
                         id='conf-applies-to',
@@ -209,11 +251,48 @@ def get_app_layout():
                         ),
                         dt.DataTable(
                             id='boxfile-table',
-                            sort_action='native',
-                            filter_action='native'
+                            page_action='custom',
+                            page_current=0,
+                            page_size=TABLE_PAGE_ROWS,
+                            page_count=1,
+                            sort_action='custom',
+                            sort_mode='multi',
+                            sort_by=[],
+                            filter_action='custom',
+                            filter_query=''
                         )
                     ], style={
                         'marginLeft': '20px'
+                    }),
+                    html.H4('Pick statistics'),
+                    html.Div([
+                        html.P('For the coordinate file selected above, optionally compared with another one.',
+                               style={'fontStyle': 'italic'}),
+                        html.Div([
+                            dcc.Dropdown(
+                                id='analytics-compare',
+                                placeholder='Compare with coordinate file...'
+                            )
+                        ], style={'display': 'inline-block', 'width': 'calc(100% - 210px)',
+                                  'verticalAlign': 'top'}),
+                        dcc.Input(
+                            id='analytics-radius',
+                            placeholder='match radius (px)',
+                            type='number',
+                            min=0,
+                            debounce=True,
+                            style={'width': '200px', 'marginLeft': '10px'}
+                        ),
+                        html.Div(id='analytics-agreement', style={'marginTop': '10px'}),
+                        dcc.Graph(
+                            id='analytics-graph',
+                            figure=go.Figure(),
+                            style={'height': '900px'},
+                            config={'displaylogo': False}
+                        )
+                    ], style={
+                        'marginLeft': '20px',
+                        'marginBottom': '20px'
                     })
                 ], style={
                     'textAlign': 'left',
@@ -225,6 +304,28 @@ def get_app_layout():
 
             html.Div([
                 html.H3('Electron Micrograph', id='mrc-name'),
+                html.Div([
+                    dcc.Input(
+                        id='session-dir',
+                        placeholder='Session: directory of micrographs and coordinate files',
+                        type='text',
+                        debounce=True,
+                        style={'width': 'calc(100% - 330px)'}
+                    ),
+                    html.Button('Open', id='session-open-btn', style={'marginLeft': '10px'}),
+                    html.Button('Prev', id='session-prev-btn', style={'marginLeft': '10px'}),
+                    html.Button('Next', id='session-next-btn', style={'marginLeft': '10px'}),
+                    html.Div(id='session-status', style={'marginTop': '5px'}),
+                ], style={
+                    'marginLeft': '20px',
+                    'marginRight': '20px',
+                    'marginBottom': '10px',
+                    'textAlign': 'left'
+                }),
+                html.Div(id='job-progress', style={
+                    'marginLeft': '20px',
+                    'textAlign': 'left'
+                }),
                 du.Upload(
                     id='upload-image',
                     max_file_size=1800,  # in MB
@@ -243,6 +344,72 @@ def get_app_layout():
                         'width': 'calc(100% - 40px)'
                     },
                 ),
+                html.Div([
+                    html.Div([
+                        dcc.Dropdown(
+                            id='contrast-mode',
+                            options=[{'label': v, 'value': k} for k, v in contrast.CONTRAST_MODES.items()],
+                            value='histeq',
+                            clearable=False,
+                            searchable=False
+                        )
+                    ], style={'display': 'inline-block', 'width': '250px', 'verticalAlign': 'top'}),
+                    html.Div([
+                        dcc.Dropdown(
+                            id='bin-mode',
+                            options=[{'label': 'No binning', 'value': 'none'}] +
+                                    [{'label': v, 'value': k} for k, v in binning.BIN_MODES.items()],
+                            value='mean',
+                            clearable=False,
+                            searchable=False
+                        )
+                    ], style={'display': 'inline-block', 'width': '170px', 'marginLeft': '10px',
+                              'verticalAlign': 'top'}),
+                    html.Div([
+                        dcc.Dropdown(
+                            id='bin-factor',
+                            options=[{'label': 'Auto', 'value': 'auto'}] +
+                                    [{'label': '%sx' % f, 'value': f} for f in binning.BIN_FACTORS],
+                            value='auto',
+                            clearable=False,
+                            searchable=False
+                        )
+                    ], style={'display': 'inline-block', 'width': '100px', 'marginLeft': '10px',
+                              'verticalAlign': 'top'}),
+                ], style={
+                    'marginTop': '10px',
+                    'marginLeft': '20px',
+                    'textAlign': 'left'
+                }),
+                html.Div([
+                    dcc.RadioItems(
+                        id='stack-mode',
+                        options=[{'label': ' %s' % v, 'value': k} for k, v in util.STACK_MODES.items()],
+                        value='frame',
+                        labelStyle={'display': 'inline-block', 'marginRight': '15px'}
+                    ),
+                    html.Div([
+                        dcc.Slider(
+                            id='frame-slider',
+                            min=0,
+                            max=0,
+                            step=1,
+                            value=0,
+                            tooltip={'placement': 'bottom'}
+                        )
+                    ], id='frame-slider-div'),
+                    html.Div([
+                        dcc.RangeSlider(
+                            id='frame-range',
+                            min=0,
+                            max=0,
+                            step=1,
+                            value=[0, 0],
+                            allowCross=False,
+                            tooltip={'placement': 'bottom'}
+                        )
+                    ], id='frame-range-div', style={'display': 'none'}),
+                ], id='stack-controls', style={'display': 'none'}),
                 # dcc.Upload(
                 #     id='upload-image',
                 #     children=html.Div(['Drag and Drop']),
@@ -269,9 +436,15 @@ def get_app_layout():
                                 # 'plot_bgcolor': 'rgba(0,0,0,0)',
                                 'autosize': True,
                                 'margin': dict(l=0, r=0, b=0, t=35, pad=5),
+                                'xaxis': {
+                                    'showgrid': False,
+                                    'zeroline': False
+                                },
                                 'yaxis': {
                                     'scaleanchor': 'x',
-                                    'scaleratio': 1
+                                    'scaleratio': 1,
+                                    'showgrid': False,
+                                    'zeroline': False
                                 }
                             }
                         ),
@@ -313,99 +486,428 @@ def box_slider_changed(value):
     return 'Show %s%% of boxes (random)' % value
 
 
+# with live filtering, slider moves restyle the overlay traces in the browser (assets/overlays.js) from the
+# arrays store_box sent along with them, which are kept there across callbacks (only redrawn overlays get new ones)
+app.clientside_callback(
+    ClientsideFunction(namespace='overlays', function_name='merge_overlays'),
+    Output('overlay-groups', 'data'),
+    [Input('overlay-arrays', 'data')])
+
+app.clientside_callback(
+    ClientsideFunction(namespace='overlays', function_name='filter_boxes'),
+    Output('overlay-filter-count', 'data'),
+    [Input('box-percent-slider', 'value')],
+    [Input('conf-range-slider', 'value')],
+    [Input('no-conf-boxes-switch', 'on')],
+    [State('overlay-groups', 'data')])
+
+
+@app.callback(
+    Output('boxfile-table', 'page_current'),
+    [Input('boxfile-dropdown', 'value')],
+    [Input('boxfile-table', 'filter_query')])
+def reset_table_page(dropdown_value, filter_query):
+    return 0
+
+
 @app.callback(
     Output('boxfile-table', 'columns'),
     Output('boxfile-table', 'data'),
+    Output('boxfile-table', 'page_count'),
     [Input('boxfile-dropdown', 'value')],
+    [Input('boxfile-table', 'page_current')],
+    [Input('boxfile-table', 'page_size')],
+    [Input('boxfile-table', 'sort_by')],
+    [Input('boxfile-table', 'filter_query')],
     [State('boxfile-memory', 'data')])
-def display_boxfile_table(dropdown_value, data):
+def display_boxfile_table(dropdown_value, page_current, page_size, sort_by, filter_query, data):
+    # filtering, sorting and paging run on the stored table, only the rows of the current page are sent
     tbl_cols = []
     tbl_data = []
-    if dropdown_value is not None and str(dropdown_value) in data['boxfiles']:
-        print("INFO: displaying table")
-        df = pd.DataFrame(data['boxfiles'][str(dropdown_value)])
-        tbl_cols = [{'name': i, 'id': i} for i in df.columns]
-        tbl_data = df.to_dict('records')
+    page_count = 1
+    df = None
+    rows = None
+    if dropdown_value is not None and str(dropdown_value) in data['filehashes']:
+        key = data['boxinfo'][str(dropdown_value)]['key']
+        df = boxstore.get(key)
+        rows = boxstore.get_table_rows(key, filter_query, sort_by)
+    if df is not None and rows is not None:
+        logger.debug("displaying table (%s of %s rows match)" % (len(rows), len(df.index)))
+        columns = [col for col in df.columns if col != 'rank']  # sampling ranks are internal
+        tbl_cols = [{'name': i, 'id': i, 'type': 'numeric'} for i in columns]
+        page_count = max(1, int(math.ceil(len(rows) / page_size)))
+        page_rows = rows[page_current * page_size:(page_current + 1) * page_size]
+        tbl_data = df[columns].iloc[page_rows].to_dict('records')
+
+    return tbl_cols, tbl_data, page_count
 
-    return tbl_cols, tbl_data
+
+# figure with the confidence histogram, nearest neighbor distance histogram and density heatmap of one file
+def make_analytics_figure(stats, color):
+    fig = make_subplots(rows=3, cols=1, vertical_spacing=0.08, subplot_titles=[
+        'Confidence', 'Nearest neighbor distance (px, median %s)' % ('%.1f' % stats['nn_median']
+                                                                   if stats['nn_median'] is not None else '-'),
+        'Picks per %.0f px cell' % stats['cell_px']])
+    for row, name in [(1, 'conf'), (2, 'nn')]:
+        edges = stats['%s_edges' % name]
+        fig.add_trace(go.Bar(x=[(a + b) / 2 for a, b in zip(edges[:-1], edges[1:])], y=stats['%s_counts' % name],
+                             width=edges[1] - edges[0], marker={'color': color}, showlegend=False), row=row, col=1)
+    cell_px = stats['cell_px']
+    density = stats['density']
+    fig.add_trace(go.Heatmap(z=density, x=[(col + 0.5) * cell_px for col in range(len(density[0]))],
+                             y=[(row + 0.5) * cell_px for row in range(len(density))], colorscale='Viridis',
+                             showscale=False), row=3, col=1)
+    fig.update_yaxes(scaleanchor='x3', scaleratio=1, row=3, col=1)
+    fig.update_layout(margin=dict(l=40, r=10, b=30, t=40), bargap=0)
+    return fig
 
 
 @app.callback(
-    Output('output-image-upload', 'children'),
+    Output('analytics-graph', 'figure'),
+    Output('analytics-agreement', 'children'),
+    [Input('boxfile-dropdown', 'value')],
+    [Input('analytics-compare', 'value')],
+    [Input('analytics-radius', 'value')],
+    [State('boxfile-memory', 'data')],
+    [State('micrograph-memory', 'data')])
+def display_analytics(dropdown_value, compare_value, radius, data, micrograph):
+    # statistics are computed on the stored tables and cached per table, only binned counts are sent
+    if dropdown_value is None or str(dropdown_value) not in data['boxinfo']:
+        return go.Figure(), None
+    key = data['boxinfo'][str(dropdown_value)]['key']
+    stats = boxstore.get_stats(key, micrograph.get('shape'))
+    if stats is None:
+        return go.Figure(), None
+    fig = make_analytics_figure(stats, util.get_color(dropdown_value)[0])
+
+    agreement = None
+    if compare_value is not None and str(compare_value) in data['boxinfo'] and compare_value != dropdown_value:
+        if not radius:  # default: half the typical box size of the selected file
+            radius = float(boxstore.get(key)['w'].median()) / 2
+        result = boxstore.get_agreement(key, data['boxinfo'][str(compare_value)]['key'], float(radius))
+        if result is not None:
+            agreement = html.P(
+                '%s of %s picks matched within %.1f px (Jaccard %.2f, median offset %s px); %.0f%% of this file\'s '
+                'picks and %.0f%% of the other\'s have a pick of the other file in range.' % (
+                    result['matched'], result['n_a'], radius, result['jaccard'],
+                    '%.1f' % result['median_offset'] if result['median_offset'] is not None else '-',
+                    result['a_near_b'] * 100, result['b_near_a'] * 100))
+    return fig, agreement
+
+
+@app.server.route('/tiles/<key>/<int:level>/<tile>')
+@protect
+def serve_tile(key, level, tile):
+    # send_from_directory rejects paths that would escape RENDER_CACHE_ROOT
+    return flask.send_from_directory(os.path.abspath(rendercache.RENDER_CACHE_ROOT), '/'.join([key, str(level), tile]))
+
+
+@app.server.route('/metrics')
+@protect
+def serve_metrics():
+    return flask.Response(metrics.get_metrics_text(), mimetype='text/plain; version=0.0.4')
+
+
+@app.server.route('/jobs/<upload_id>/<job_name>')
+@protect
+def job_status(upload_id, job_name):
+    if upload_id.startswith('.') or job_name.startswith('.'):
+        flask.abort(404)
+    return flask.jsonify(jobs.get_status(os.path.join(UPLOAD_ROOT, upload_id, job_name)))
+
+
+# micrograph store entry for a finished render job (None if its render was evicted in the meantime)
+# view_id stays the same across frames/contrast modes of one upload, so those keep the current zoom
+def get_rendered_micrograph(status, job):
+    meta = rendercache.lookup(status['key'])
+    if meta is None:
+        return None
+    return dict(meta, filename=job['filename'], view_id=job['view_id'], boxfiles=job.get('boxfiles'),
+                display_px=job.get('display_px'), tile_url='/tiles/%s' % status['key'])
+
+
+# progress indicator shown while a micrograph is being preprocessed
+def make_job_progress(status):
+    if status['state'] == 'error':
+        return html.P('Could not load micrograph (%s)' % status['error'], style={'color': 'red'})
+    return html.Div([
+        html.Progress(value=str(round(status['progress'] * 100)), max='100'),
+        html.Span(' %s...' % (status['stage'] or 'queued'))
+    ])
+
+
+@app.callback(
+    Output('stack-controls', 'style'),
+    Output('frame-slider', 'max'),
+    Output('frame-slider', 'marks'),
+    Output('frame-slider', 'value'),
+    Output('frame-range', 'max'),
+    Output('frame-range', 'marks'),
+    Output('frame-range', 'value'),
+    [Input('upload-image', 'isCompleted')],
+    [Input('session-memory', 'data')],
+    [State('upload-image', 'fileNames')],
+    [State('upload-image', 'upload_id')])
+def update_stack_controls(upload_done, session_data, filenames, upload_id):
+    # stack controls are only shown for stacks/volumes, which are reset to their first frame on upload or when
+    # moving through a session (whose micrograph takes precedence, as in load_micrograph)
+    item = session.get_item(session_data['id'], session_data['position']) if session_data else None
+    if item is not None:
+        mrc_path = item['mrc']
+    elif upload_done and filenames:
+        mrc_path = Path(UPLOAD_ROOT) / upload_id / filenames[0]
+    else:
+        mrc_path = None
+
+    n = 1
+    if mrc_path is not None:
+        try:
+            with util.open_mrc(mrc_path) as mrc:
+                n = util.get_n_sections(mrc)
+        except (OSError, ValueError) as e:
+            logger.warning("could not read mrc header (%s)" % e)
+
+    style = {'marginTop': '10px', 'marginLeft': '20px', 'marginRight': '20px', 'textAlign': 'left'}
+    if n == 1:
+        style['display'] = 'none'
+    marks = {0: '1', n - 1: str(n)}
+    return style, n - 1, marks, 0, n - 1, marks, [0, n - 1]
+
+
+@app.callback(
+    Output('frame-slider-div', 'style'),
+    Output('frame-range-div', 'style'),
+    [Input('stack-mode', 'value')])
+def toggle_frame_sliders(stack_mode):
+    if stack_mode == 'frame':
+        return {}, {'display': 'none'}
+    return {'display': 'none'}, {}
+
+
+@app.callback(
+    Output('session-memory', 'data'),
+    Output('session-status', 'children'),
+    [Input('session-open-btn', 'n_clicks')],
+    [Input('session-dir', 'n_submit')],
+    [Input('session-prev-btn', 'n_clicks')],
+    [Input('session-next-btn', 'n_clicks')],
+    [Input('upload-image', 'isCompleted')],
+    [State('session-dir', 'value')],
+    [State('session-memory', 'data')])
+def navigate_session(open_clicks, n_submit, prev_clicks, next_clicks, upload_done, session_dir, session_data):
+    # an uploaded micrograph replaces the session, prev/next move through the session's micrographs
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'upload-image.isCompleted' in triggered:
+        return ({}, None) if upload_done else (dash.no_update, dash.no_update)
+
+    if 'session-open-btn.n_clicks' in triggered or 'session-dir.n_submit' in triggered:
+        path = session.resolve_dir(session_dir or '')
+        if path is None:
+            return dash.no_update, html.Span('No such directory under %s' % session.SESSION_DATA_ROOT,
+                                             style={'color': 'red'})
+        logger.info("opening session (path = %s)" % path)
+        session_id, index = session.open_session(path)
+        storage.start_sweeper(UPLOAD_ROOT)  # also expires sessions and STAR indexes
+        if not index['items']:
+            return {}, html.Span('No micrographs in %s' % path, style={'color': 'red'})
+        session_data = {'id': session_id, 'position': 0, 'count': len(index['items'])}
+    elif session_data and ('session-prev-btn.n_clicks' in triggered or 'session-next-btn.n_clicks' in triggered):
+        step = -1 if 'session-prev-btn.n_clicks' in triggered else 1
+        position = min(max(session_data['position'] + step, 0), session_data['count'] - 1)
+        if position == session_data['position']:
+            return dash.no_update, dash.no_update
+        session_data = dict(session_data, position=position)
+    else:
+        return dash.no_update, dash.no_update
+
+    return session_data, 'Micrograph %s of %s' % (session_data['position'] + 1, session_data['count'])
+
+
+# graph width in device px, measured in the browser when a micrograph is uploaded or opened from a session
+# (picks the binning factor and the tile pyramid level to serve)
+app.clientside_callback(
+    """
+    function(upload_done, session_data) {
+        var graph = document.getElementById('micrograph');
+        return graph ? Math.round(graph.getBoundingClientRect().width * (window.devicePixelRatio || 1)) : null;
+    }
+    """,
+    Output('graph-size', 'data'),
+    [Input('upload-image', 'isCompleted')],
+    [Input('session-memory', 'data')])
+
+
+@app.callback(
+    Output('micrograph-memory', 'data'),
     Output('mrc-name', 'children'),
+    Output('job-memory', 'data'),
+    Output('job-poll', 'disabled'),
+    Output('job-progress', 'children'),
     [Input('upload-image', 'isCompleted')],
+    [Input('contrast-mode', 'value')],
+    [Input('stack-mode', 'value')],
+    [Input('frame-slider', 'value')],
+    [Input('frame-range', 'value')],
+    [Input('bin-mode', 'value')],
+    [Input('bin-factor', 'value')],
+    [Input('graph-size', 'data')],
+    [Input('session-memory', 'data')],
+    [Input('job-poll', 'n_intervals')],
     [State('upload-image', 'fileNames')],
     [State('upload-image', 'upload_id')],
-    [State('micrograph', 'figure')],
-    [State('micrograph', 'style')],
-    [State('micrograph', 'config')])
-def load_micrograph(upload_done, filenames, upload_id, graph_figure, graph_style, graph_config):
-    fig = go.Figure()
-    filename = 'Electron Micrograph'
-    if upload_done and filenames:
-        filename = filenames[0]
-        print("INFO: loading mrc")
-        with mrcfile.open(Path(UPLOAD_ROOT) / upload_id / filename, mode='r', permissive=True) as mrc:
-            # content_type, content_string = contents.split(',')
-            # decoded = base64.b64decode(content_string)
-            # interpreter = mrcinterpreter.MrcInterpreter(iostream=BytesIO(decoded), permissive=True)
-            # mrc_raw = interpreter.data
-            mrc_raw = mrc.data
-            mrc_histeq = util.hist_equalize(mrc_raw)
+    [State('job-memory', 'data')],
+    [State('manual-boxsize', 'value')])
+def load_micrograph(upload_done, contrast_mode, stack_mode, frame, frame_range, bin_mode, bin_factor, graph_px,
+                    session_data, n_intervals, filenames, upload_id, job, manual_boxsize):
+    # polling only checks on the running job and swaps the micrograph in once its tiles are ready, or loads the
+    # micrograph once its upload has been checked
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'job-poll.n_intervals' in triggered and not (job or {}).get('checking'):
+        if not job:
+            return dash.no_update, dash.no_update, dash.no_update, True, None
+        status = jobs.get_status(job['job_dir'])
+        micrograph = get_rendered_micrograph(status, job) if status['state'] == 'done' else None
+        if micrograph is not None:
+            logger.debug("loading mrc done")
+            return micrograph, dash.no_update, {}, True, None
+        if status['state'] == 'error':
+            return dash.no_update, dash.no_update, {}, True, make_job_progress(status)
+        return dash.no_update, dash.no_update, dash.no_update, False, make_job_progress(status)
 
-            fig = px.imshow(mrc_histeq, binary_string=True, origin='lower', aspect='equal')
+    # stack options are ignored by the job for single micrographs, an 'auto' bin factor is resolved from graph_px
+    params = {'contrast': contrast_mode, 'stack': stack_mode,
+              'frames': [frame, frame] if stack_mode == 'frame' else frame_range,
+              'bin': bin_mode, 'bin_factor': bin_factor, 'display_px': graph_px}
+    item = session.get_item(session_data['id'], session_data['position']) if session_data else None
+    content_hash = None
+    if item is not None:  # micrograph from an open session, whose coordinate files are loaded along with it
+        filename = os.path.basename(item['mrc'])
+        mrc_path = item['mrc']
+        job = {'job_dir': jobs.get_job_dir(session.SESSION_ROOT, session_data['id'], filename, params,
+                                           jobs.get_content_id(mrc_path)),
+               'filename': filename, 'view_id': '%s/%s' % (session_data['id'], filename),
+               'boxfiles': item['boxfiles'], 'display_px': graph_px}
+        session.prefetch(session_data['id'], session_data['position'],
+                         lambda next_item: prefetch_session_item(next_item, session_data['id'], params, manual_boxsize),
+                         prefetch_key=json.dumps([params, manual_boxsize], sort_keys=True))
+    elif upload_done and filenames:
+        filename = filenames[0]
+        upload = storage.process_upload(UPLOAD_ROOT, upload_id, filename)
+        if upload is None:  # hashed and checked in the background first
+            return dash.no_update, filename, {'checking': True}, False, make_job_progress(
+                {'state': 'running', 'progress': 0.0, 'stage': 'checking upload'})
+        if upload['error'] is not None:
+            return {}, filename, {}, True, make_job_progress({'state': 'error', 'error': upload['error']})
+        content_hash = upload['hash']
+        mrc_path = Path(UPLOAD_ROOT) / upload_id / filename
+        job = {'job_dir': jobs.get_job_dir(UPLOAD_ROOT, upload_id, filename, params, content_hash),
+               'filename': filename, 'view_id': '%s/%s' % (upload_id, filename), 'display_px': graph_px}
+    else:
+        return {}, 'Electron Micrograph', {}, True, None
 
-        if 'data' in graph_figure:
-            for trace in graph_figure['data']:
-                if trace not in fig['data'] and (trace['type'] == 'scatter' or trace['type'] == 'scattergl'):
-                    fig.add_trace(trace)
+    logger.debug("loading mrc")
+    status = jobs.submit_render(mrc_path, job['job_dir'], params, content_hash)
+    micrograph = get_rendered_micrograph(status, job) if status['state'] == 'done' else None
+    if micrograph is not None:  # rendered before, tiles are in the cache
+        return micrograph, filename, {}, True, None
+    return dash.no_update, filename, job, False, make_job_progress(status)
 
-        print("INFO: loading mrc done")
 
-    fig.update_layout(graph_figure['layout'])
-
-    return html.Div([
-        dcc.Graph(
-            id='micrograph',
-            figure=fig,
-            style=graph_style,
-            config=graph_config
-        )]), filename
+# render a session micrograph and store its coordinate tables ahead of time (runs in session's prefetch pool)
+def prefetch_session_item(item, session_id, params, manual_boxsize):
+    filename = os.path.basename(item['mrc'])
+    job_dir = jobs.get_job_dir(session.SESSION_ROOT, session_id, filename, params, jobs.get_content_id(item['mrc']))
+    jobs.submit_render(item['mrc'], job_dir, params)
+    for path in item['boxfiles']:
+        store_box_table(Path(path), os.path.basename(path), util.hash_file(path), manual_boxsize, item['stem'],
+                        reuse=True)
 
 
 @app.callback(
     Output('boxfile-checklist', 'options'),
     Output('boxfile-checklist', 'value'),
     Output('boxfile-dropdown', 'options'),
+    Output('analytics-compare', 'options'),
     [Input('boxfile-memory', 'data')],
     [State('boxfile-checklist', 'options')],
     [State('boxfile-checklist', 'value')])
 def update_boxfile_checklist(data, checklist_opts, checklist_vals):
     loaded_boxfiles = data['filenames']
-    print("INFO: checklist updated (loaded_boxfiles = %s)" % len(loaded_boxfiles))
+    logger.debug("checklist updated (loaded_boxfiles = %s)" % len(loaded_boxfiles))
     if len(loaded_boxfiles) == 0:
-        return checklist_opts, checklist_vals, []
+        return checklist_opts, checklist_vals, [], []
     else:
         boxfile_list = [{'label': ' %s (%s): %s' % (k, util.get_color(k)[1], v), 'disabled': True, 'value': k}
                         for k, v in loaded_boxfiles.items()]
-        for i in range(len(boxfile_list)):
-            if (pd.DataFrame(data['boxfiles'][str(i + 1)])['conf'] == util.NO_CONF_VAL).all():
-                boxfile_list[i]['label'] = ' *' + boxfile_list[i]['label']
+        for d in boxfile_list:
+            if not data['boxinfo'][d['value']]['has_conf']:
+                d['label'] = ' *' + d['label']
         all_vals = [k for k, _ in loaded_boxfiles.items()]
         dropdown_list = []
         for d in boxfile_list:
             e = d.copy()
             e.update({'disabled': False})
             dropdown_list.append(e)
-        return boxfile_list, all_vals, dropdown_list
+        return boxfile_list, all_vals, dropdown_list, dropdown_list
+
+
+# parse coordinate file and save its table, returning its boxfile-memory info (None if manual box size is needed)
+# STAR files covering many micrographs are indexed once and only the rows of the loaded micrograph are read
+# with reuse, a table already stored for the same file contents and box size isn't parsed again
+def store_box_table(path, filename, filehash, manual_boxsize, mic_stem, reuse=False):
+    info = {'key': filehash + ('_%s' % manual_boxsize if manual_boxsize else '')}
+    index = util.index_star(path) if os.path.splitext(filename)[-1].lower() == '.star' else None
+    indexed = index is not None and len(index['micrographs']) > 1
+    if indexed:
+        info.update({'key': '%s_%s' % (info['key'], mic_stem), 'indexed': True, 'path': str(path),
+                     'micrograph': mic_stem, 'boxsize': manual_boxsize})
+    df = boxstore.get(info['key']) if reuse else None
+    if df is None:
+        if indexed:
+            df = util.read_star_micrograph(path, index, mic_stem, filename, manual_boxsize)
+        else:
+            df = util.parse_boxfile(path, filename, manual_boxsize)
+        if df is None:
+            return None
+        boxstore.put(info['key'], df)  # only the key and metadata go to the browser
+
+    info.update({
+        'count': len(df.index),
+        'has_conf': bool((df['conf'] != util.NO_CONF_VAL).any())
+    })
+    return info
+
+
+# boxes of a stored table to draw around region (all of them if None), decimated up front with live filtering
+# since the browser filters them itself (returns boxes, whether they were decimated; None if not stored)
+def get_overlay_boxes(key, region, live):
+    df = boxstore.get(key)
+    if df is None:
+        return None, False
+    if region is not None:  # only boxes around the visible part of the micrograph
+        pad = max(df['w'].max(), df['h'].max()) / 2 if len(df.index) else 0
+        df = df.iloc[spatial.query_grid_index(boxstore.get_grid(key), df['x'].to_numpy(), df['y'].to_numpy(),
+                                              region, pad=pad)]
+    return spatial.decimate(df) if live else (df, False)
+
+
+# whether overlay traces were drawn with the same table and filters for a region that still fits the view
+def can_reuse_traces(traces, signature, view_box):
+    return all(isinstance(trace['meta'], dict) and trace['meta']['signature'] == signature and
+               spatial.can_reuse_region(trace['meta']['region'], trace['meta']['decimated'], view_box)
+               for trace in traces)
 
 
 @app.callback(
     Output('boxfile-memory', 'data'),
     Output('manual-boxsize-title', 'children'),
     Output('micrograph', 'figure'),
+    Output('overlay-arrays', 'data'),
     [Input('upload-box', 'isCompleted')],
     [Input('apply-btn', 'n_clicks')],
+    [Input('micrograph-memory', 'data')],
+    [Input('micrograph', 'relayoutData')],
+    [Input('live-filter', 'value')],
     [State('upload-box', 'fileNames')],
     [State('upload-box', 'upload_id')],
     [State('manual-boxsize', 'value')],
@@ -414,43 +916,152 @@ def update_boxfile_checklist(data, checklist_opts, checklist_vals):
     [State('box-percent-slider', 'value')],
     [State('conf-range-slider', 'value')],
     [State('no-conf-boxes-switch', 'on')])
-def store_box(upload_done, n_clicks, filenames, upload_id, manual_boxsize, data, figure, box_percent, conf_range,
-              show_no_conf_boxes):
+def store_box(upload_done, n_clicks, micrograph, relayout_data, live_filter, filenames, upload_id, manual_boxsize,
+              data, figure, box_percent, conf_range, show_no_conf_boxes):
     fig = go.Figure(data=figure['data'], layout=figure['layout'])
+    fig_changed = False
 
-    if upload_done and filenames:
+    # zoom/pan swaps the image tiles and the boxes drawn around the view, micrograph loads also reload
+    # overlays of indexed STAR files and swap in session coordinate files; uploaded box files are only (re)read
+    # on upload or Apply
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    mic_stem = os.path.splitext(micrograph['filename'])[0] if 'filename' in micrograph else None
+    if 'micrograph-memory.data' in triggered:
+        fig_changed = True
+        new_view = fig.layout.uirevision != micrograph.get('view_id')
+        if 'tile_url' not in micrograph:
+            data['viewport'] = None
+            fig.update_layout(images=[])
+        elif not new_view:  # another frame or contrast mode, keep the zoom
+            view_box = data['viewport']
+            fig.update_layout(images=tiles.viewport_images(micrograph, (view_box[:2], view_box[2:]) if view_box
+                                                           else None, micrograph.get('display_px')))
+        else:
+            data['viewport'] = None
+            h, w = micrograph['shape']
+            fig.update_layout(images=tiles.viewport_images(micrograph, display_px=micrograph.get('display_px')),
+                              uirevision=micrograph['view_id'],
+                              xaxis_range=[-0.5, w - 0.5], yaxis_range=[-0.5, h - 0.5])
+
+        # coordinate files of a session micrograph replace those of the previous one (reusing their colors)
+        free_keys = []
+        if new_view:
+            free_keys = sorted([i for i, info in data['boxinfo'].items() if info.get('session')], key=int)
+            for i in free_keys:
+                for field in ['boxinfo', 'filenames', 'filehashes']:
+                    del data[field][i]
+
+        # overlays from indexed STAR files follow the loaded micrograph
+        for i, info in data['boxinfo'].items():
+            if info.get('indexed') and info['micrograph'] != mic_stem:
+                data['boxinfo'][i] = store_box_table(Path(info['path']), data['filenames'][i], data['filehashes'][i],
+                                                     info['boxsize'], mic_stem, reuse=True)
+
+        for path in (micrograph.get('boxfiles') or []) if new_view else []:
+            filename = os.path.basename(path)
+            hashed = util.hash_file(path)
+            if hashed in data['filehashes'].values():
+                continue
+            info = store_box_table(Path(path), filename, hashed, manual_boxsize, mic_stem, reuse=True)
+            if info is None:
+                logger.warning("%s needs a manual box size" % filename)
+                continue
+            info['session'] = True
+            if free_keys:
+                key = free_keys.pop(0)
+            else:
+                data['boxfile-counter'] = data['boxfile-counter'] + 1
+                key = str(data['boxfile-counter'])
+            data['filenames'][key] = filename
+            data['filehashes'][key] = hashed
+            data['boxinfo'][key] = info
+
+    if 'micrograph.relayoutData' in triggered:
+        viewport = util.get_viewport(relayout_data)
+        if viewport is None:
+            return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+        data['viewport'] = spatial.get_view_box(viewport, micrograph.get('shape'))
+        if 'tile_url' in micrograph:
+            fig.update_layout(images=tiles.viewport_images(micrograph, viewport, micrograph.get('display_px')))
+            fig_changed = True
+
+    boxsize_title = dash.no_update
+    if upload_done and filenames and ('upload-box.isCompleted' in triggered or 'apply-btn.n_clicks' in triggered):
+        boxsize_title = manual_boxsize_title
         for filename in filenames:
-            print("INFO: storing boxfile (filename = %s)" % filename)
-            with open(Path(UPLOAD_ROOT) / upload_id / filename, mode='r') as file:
-                file_str = file.read()
-                # content_type, content_string = contents.split(',')
-                # decoded = base64.b64decode(content_string)
-                # last_uploaded_df = util.parse_boxfile(StringIO(boxfile.decode('utf-8')), filename, manual_boxsize)
-                hashed = hashlib.md5(file_str.encode('utf-8')).hexdigest()
-                last_uploaded_df = util.parse_boxfile(file_str, filename, manual_boxsize)
-
-            fig['data'] = [trace for trace in fig['data'] if trace['type'] != 'scatter' and trace['type'] != 'scattergl']
-            for i in range(1, data['boxfile-counter'] + 1):
-                df = pd.DataFrame(data['boxfiles'][str(i)])
-                boxes = util.filter_df(df, box_percent, conf_range, keep_no_conf=show_no_conf_boxes)
-                fig.add_traces(util.make_trace(boxes, util.get_color(i)[0], data['filenames'][str(i)],
-                                               data['filehashes'][str(i)]))
+            logger.info("storing boxfile (filename = %s)" % filename)
+            upload = storage.process_upload(UPLOAD_ROOT, upload_id, filename, wait=True)  # small, not worth polling
+            if upload['error'] is not None:
+                logger.warning("could not store %s (%s)" % (filename, upload['error']))
+                continue
+            path = Path(UPLOAD_ROOT) / upload_id / filename
+            hashed = upload['hash']
 
             if hashed in data['filehashes'].values():
-                return data, manual_boxsize_title, fig
+                continue
 
-            if last_uploaded_df is None:
-                return data, manual_boxsize_warning, fig
+            info = store_box_table(path, filename, hashed, manual_boxsize, mic_stem)
+            if info is None:
+                boxsize_title = manual_boxsize_warning
+                continue
 
             data['boxfile-counter'] = data['boxfile-counter'] + 1
-            data['filenames'][data['boxfile-counter']] = filename
-            data['filehashes'][data['boxfile-counter']] = hashed
-            data['boxfiles'][data['boxfile-counter']] = last_uploaded_df.to_dict()
+            counter = str(data['boxfile-counter'])
+            data['filenames'][counter] = filename
+            data['filehashes'][counter] = hashed
+            data['boxinfo'][counter] = info
+
+    # only recompute overlays whose file, filter settings or visible region changed since their traces were made,
+    # all others are carried over from the current figure as they are
+    # with live filtering the browser also gets the unfiltered boxes of every redrawn overlay, which the sliders
+    # then filter there (assets/overlays.js), while traces sent from here are already filtered with the current
+    # settings; carried over overlays keep the boxes the browser already has
+    live = 'live' in (live_filter or [])
+    view_box = data.get('viewport')
+    region = spatial.get_cull_region(view_box)
+    old_traces = {}
+    for trace in fig['data']:
+        if trace['type'] == 'scatter' or trace['type'] == 'scattergl':
+            old_traces.setdefault(trace['legendgroup'], []).append(trace)
+    traces = [trace for trace in fig['data'] if trace['type'] != 'scatter' and trace['type'] != 'scattergl']
+    overlays_changed = False
+    overlay_arrays = {}  # {filehash: encoded boxes} of redrawn overlays with live filtering
+    live_groups = []  # filehashes of all overlays drawn with live filtering
+    for i in sorted(data['boxinfo'], key=int):
+        filehash = data['filehashes'][i]
+        key = data['boxinfo'][i]['key']
+        signature = '%s %s %s %s %s' % (key, box_percent, conf_range, show_no_conf_boxes, live)
+        if filehash in old_traces and can_reuse_traces(old_traces[filehash], signature, view_box):
+            traces.extend(old_traces.pop(filehash))
+            if live:
+                live_groups.append(filehash)
+            continue
 
-            boxes = util.filter_df(last_uploaded_df, box_percent, conf_range, keep_no_conf=show_no_conf_boxes)
+        candidates, decimated = get_overlay_boxes(key, region, live)
+        if candidates is None:
+            logger.warning("coordinate table for %s is no longer stored" % data['filenames'][i])
+            continue
+        boxes = util.filter_df(candidates, box_percent, conf_range, keep_no_conf=show_no_conf_boxes)
+        if not live:
+            boxes, decimated = spatial.decimate(boxes)
+        else:
+            overlay_arrays[filehash] = util.encode_overlay(candidates)
+            live_groups.append(filehash)
+        if decimated:
+            logger.debug("drawing %s of the boxes in view for %s" % (len(boxes.index), data['filenames'][i]))
+        new_traces = util.make_trace(boxes, util.get_color(i)[0], data['filenames'][i], filehash,
+                                     keep_empty=live and len(candidates.index) > 0)
+        for trace in new_traces:
+            trace['meta'] = {'signature': signature, 'region': region, 'decimated': decimated}
+        traces.extend(new_traces)
+        old_traces.pop(filehash, None)
+        overlays_changed = True
 
-            fig.add_traces(util.make_trace(boxes, util.get_color(data['boxfile-counter'])[0], filename, hashed))
+    if not overlays_changed and not old_traces:  # overlays didn't change
+        logger.debug("boxfile storage reloaded (overlays unchanged)")
+        return data, boxsize_title, fig if fig_changed else dash.no_update, dash.no_update
 
+    fig = go.Figure(data=traces, layout=fig['layout'])
     fig.update_layout({
         'legend': {
             'orientation': 'h',
@@ -461,16 +1072,13 @@ def store_box(upload_done, n_clicks, filenames, upload_id, manual_boxsize, data,
         }
     })
 
-    print("INFO: boxfile storage reloaded")
-    # print(fig)
-    return data, manual_boxsize_title, fig
+    logger.debug("boxfile storage reloaded")
+    return data, boxsize_title, fig, {'arrays': overlay_arrays, 'groups': live_groups}
 
 
-try:
-    get_ipython
+if 'ipykernel' in sys.modules:
     app.run_server(mode='inline')
     print("Detected IPython environment (running inline)")
-except Exception:
-    if __name__ == '__main__':
-        app.run_server(debug=False)
-        print("Running in server mode")
+elif __name__ == '__main__':
+    app.run_server(debug=False)
+    print("Running in server mode")
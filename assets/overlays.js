@@ -0,0 +1,92 @@
+// clientside filtering of box overlays: store_box ships the boxes of each redrawn overlay as base64 arrays
+// (overlay-arrays store), they're decoded and kept here while the overlay stays drawn, and slider moves restyle
+// the overlay traces from them without a server round trip
+
+var decodedOverlays = {};  // decoded arrays by overlay (legend group)
+
+function decodeBase64(encoded) {
+    var bytes = atob(encoded);
+    var buffer = new Uint8Array(bytes.length);
+    for (var i = 0; i < bytes.length; i++) {
+        buffer[i] = bytes.charCodeAt(i);
+    }
+    return buffer.buffer;
+}
+
+function decodeOverlay(encoded) {
+    var arrays = {};
+    ['x', 'y', 'w', 'h', 'rank'].forEach(function(col) {
+        arrays[col] = new Float32Array(decodeBase64(encoded[col]));
+    });
+    arrays.conf = new Float64Array(decodeBase64(encoded.conf));  // compared like util.filter_df does
+    return arrays;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    overlays: {
+        // take in the arrays of redrawn overlays and drop those of overlays no longer drawn with live filtering
+        // (overlays carried over keep theirs), returning the overlays that have arrays
+        merge_overlays: function(overlay_arrays) {
+            if (!overlay_arrays || !overlay_arrays.groups) {
+                return window.dash_clientside.no_update;
+            }
+            Object.keys(decodedOverlays).forEach(function(group) {
+                if (overlay_arrays.groups.indexOf(group) === -1) {
+                    delete decodedOverlays[group];
+                }
+            });
+            Object.keys(overlay_arrays.arrays).forEach(function(group) {
+                decodedOverlays[group] = decodeOverlay(overlay_arrays.arrays[group]);
+            });
+            return Object.keys(decodedOverlays);
+        },
+
+        // same selection as util.filter_df: rank below box_percent and confidence in range (or missing)
+        filter_boxes: function(box_percent, conf_range, show_no_conf, overlay_groups) {
+            var graph = document.querySelector('#micrograph .js-plotly-plot');
+            if (!overlay_groups || !overlay_groups.length || !graph || !graph.data) {
+                return window.dash_clientside.no_update;
+            }
+            var conf_low = conf_range[0] / 100, conf_high = conf_range[1] / 100, max_rank = box_percent / 100;
+            var update = {x: [], y: [], customdata: []};
+            var indices = [];
+            var shown = 0;
+            graph.data.forEach(function(trace, index) {
+                var a = decodedOverlays[trace.legendgroup];
+                if (!a) {
+                    return;
+                }
+                var x = [], y = [], customdata = [];
+                for (var i = 0; i < a.x.length; i++) {
+                    var no_conf = a.conf[i] === -1;
+                    if (a.rank[i] >= max_rank || (no_conf ? !show_no_conf : a.conf[i] < conf_low || a.conf[i] > conf_high)) {
+                        continue;
+                    }
+                    if (trace.mode === 'lines') {
+                        var x0 = a.x[i] - a.w[i] / 2, x1 = a.x[i] + a.w[i] / 2;
+                        var y0 = a.y[i] - a.h[i] / 2, y1 = a.y[i] + a.h[i] / 2;
+                        if (x.length) {
+                            x.push(null);
+                            y.push(null);
+                        }
+                        x.push(x0, x1, x1, x0, x0);
+                        y.push(y0, y0, y1, y1, y0);
+                        shown++;
+                    } else {
+                        x.push(a.x[i]);
+                        y.push(a.y[i]);
+                        customdata.push([a.x[i], a.y[i], a.conf[i]]);
+                    }
+                }
+                update.x.push(x);
+                update.y.push(y);
+                update.customdata.push(trace.mode === 'lines' ? null : customdata);
+                indices.push(index);
+            });
+            if (indices.length) {
+                Plotly.restyle(graph, update, indices);
+            }
+            return shown;
+        }
+    }
+});
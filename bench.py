@@ -0,0 +1,423 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import mrcfile
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.io as pio
+import contrast
+import util
+
+BOX_EXTS = ['.box', '.cbox', '.coord', '.star']
+BOXSIZE = 160  # box edge in px of synthetic boxes (and manual box size for formats without one)
+REGRESSION_RATIO = 1.2  # --compare flags results slower (or larger) than this times the baseline
+HEAVY_MODULES = ['scipy', 'IPython', 'matplotlib', 'dash_auth', 'jupyter_dash']  # not for startup
+IMPORT_REPORT_TOP = 8  # slowest imports listed by the startup benchmark
+
+# run in a fresh interpreter by bench_startup: imports the app the way a gunicorn master does with --preload,
+# then forks a worker that serves the page, its layout and callback list, and prints what both measured as JSON
+STARTUP_PROBE = '''
+import json, os, sys, time
+start = time.perf_counter()
+import app
+import_s = time.perf_counter() - start
+import bench
+master = bench.get_memory()
+read_fd, write_fd = os.pipe()
+pid = os.fork()
+if pid == 0:
+    client = app.server.test_client()
+    for path in ['/', '/_dash-layout', '/_dash-dependencies']:
+        client.get(path)
+    worker = dict(bench.get_memory(), heavy=[m for m in bench.HEAVY_MODULES if m in sys.modules])
+    os.write(write_fd, json.dumps(worker).encode('utf-8'))
+    os._exit(0)
+os.waitpid(pid, 0)
+print(json.dumps({'import_s': import_s, 'master': master, 'worker': json.loads(os.read(read_fd, 2 ** 16))}))
+'''
+
+results = []  # rows recorded by the benchmarks, written out with --save
+
+
+# original matplotlib-based histogram equalization, kept as the baseline for the contrast benchmark
+def legacy_hist_equalize(img_arr):
+    from matplotlib import pyplot as plt
+    hist_fig = plt.figure()
+    hist_arr, bins, _ = plt.hist(img_arr.ravel(), bins='auto', density=True)
+    cdf = hist_arr.cumsum()  # cumulative distribution function
+    cdf = 255 * cdf / cdf[-1]  # normalize
+    plt.close(hist_fig)
+    img_equalized = np.interp(img_arr.ravel(), bins[:-1], cdf)
+    return np.array(img_equalized.reshape(img_arr.shape))
+
+
+# original iterrows-based util.make_trace, kept as the baseline for the trace benchmark
+def legacy_make_trace(df, color, filename, filehash):
+    x = []
+    y = []
+    data = []
+    for i, row in df.iterrows():
+        x0 = row['x'] - row['w'] / 2
+        x1 = row['x'] + row['w'] / 2
+        y0 = row['y'] - row['h'] / 2
+        y1 = row['y'] + row['h'] / 2
+        x.extend([x0, x1, x1, x0, x0, None])  # have to bring the trace around to original point
+        y.extend([y0, y0, y1, y1, y0, None])  # None terminates each box
+        data.append((row['x'], row['y'], row['conf']))
+
+    if len(x) == 0 or len(y) == 0:
+        return []
+
+    if x[-1] is None:
+        del x[-1]
+    if y[-1] is None:
+        del y[-1]
+
+    return [go.Scattergl(x=x, y=y, mode='lines', line={'color': color}, name=filename, legendgroup=filehash,
+                         showlegend=True, hoverinfo='none'),
+            go.Scattergl(x=list(zip(*data))[0], y=list(zip(*data))[1], mode='markers', marker={'color': color},
+                         opacity=0, name=filename, legendgroup=filehash, showlegend=False, customdata=data,
+                         hovertemplate='<b>confidence</b>: %{customdata[2]:.2f}' +
+                                       '<br>center-x: %{customdata[0]:.2f}' +
+                                       '<br>center-y: %{customdata[1]:.2f}')]
+
+
+# best wall time (s) over repeated calls of fn
+def best_time(fn, *args, repeat=3, **kwargs):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# best wall time (s) over repeated calls of fn and peak Python heap (bytes) allocated during one more call
+def measure(fn, *args, repeat=3, **kwargs):
+    elapsed = best_time(fn, *args, repeat=repeat, **kwargs)
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def record(bench, case, **values):
+    results.append(dict(values, bench=bench, case=str(case)))
+
+
+# synthetic float32 micrograph: smooth background, gaussian noise and some hot pixels
+def make_micrograph(size, seed=0):
+    rng = np.random.default_rng(seed)
+    img = rng.normal(size=(size, size)).astype(np.float32)
+    img += np.linspace(0, 2, size, dtype=np.float32)[None, :]
+    img.ravel()[rng.integers(0, img.size, size)] = 50
+    return img
+
+
+def bench_contrast(sizes, repeat):
+    print("%-8s %12s %12s %12s %12s %9s" % ('size', 'legacy (s)', 'histeq (s)', 'percentile', 'clahe (s)', 'speedup'))
+    for size in sizes:
+        img = make_micrograph(size)
+        out = np.empty(img.shape, dtype=np.uint8)
+        try:
+            legacy = best_time(legacy_hist_equalize, img, repeat=repeat)
+        except ImportError:  # matplotlib isn't a server dependency anymore
+            legacy = float('nan')
+        histeq = best_time(contrast.equalize, img, out=out, repeat=repeat)
+        percentile = best_time(contrast.percentile_clip, img, out=out, repeat=repeat)
+        clahe = best_time(contrast.clahe, img, out=out, repeat=repeat)
+        print("%-8s %12.3f %12.3f %12.3f %12.3f %8.1fx" % (size, legacy, histeq, percentile, clahe, legacy / histeq))
+        record('contrast', size, histeq_s=histeq, percentile_s=percentile, clahe_s=clahe)  # legacy is only a reference
+
+
+# synthetic parsed coordinate table (as returned by util.parse_boxfile) with n boxes on a size x size micrograph
+def make_boxes(n, size=4096, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'x': rng.uniform(0, size, n), 'y': rng.uniform(0, size, n), 'w': np.full(n, 160.0),
+                         'h': np.full(n, 160.0), 'conf': rng.uniform(0, 1, n)})
+
+
+# write n synthetic boxes on a size x size micrograph in one of the coordinate file formats (.box/.cbox give the
+# lower left corner and box size, .coord/.star only centers)
+def write_boxfile(path, n, size=4096, seed=0):
+    df = make_boxes(n, size=size, seed=seed)
+    ext = os.path.splitext(path)[-1].lower()
+    corner_x, corner_y = df['x'] - df['w'] / 2, df['y'] - df['h'] / 2
+    if ext == '.box':
+        np.savetxt(path, np.column_stack([corner_x, corner_y, df['w'], df['h']]), fmt='%.1f', delimiter='\t')
+    elif ext == '.cbox':
+        np.savetxt(path, np.column_stack([corner_x, corner_y, df['w'], df['h'], df['conf']]),
+                   fmt=['%.1f'] * 4 + ['%.4f'], delimiter='\t')
+    elif ext == '.coord':
+        np.savetxt(path, np.column_stack([df['x'], df['y']]), fmt='%.1f', delimiter='\t')
+    elif ext == '.star':
+        header = 'data_\n\nloop_\n_rlnCoordinateX #1\n_rlnCoordinateY #2\n_rlnFigureOfMerit #3'
+        np.savetxt(path, np.column_stack([df['x'], df['y'], df['conf']]), fmt=['%.1f', '%.1f', '%.4f'],
+                   header=header, comments='')
+
+
+# write synthetic micrograph as an mrc file
+def write_mrc(path, size, seed=0):
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(make_micrograph(size, seed=seed))
+
+
+def bench_load(sizes, repeat, scratch):
+    print("%-8s %12s %12s %12s" % ('size', 'read (s)', 'histeq (s)', 'peak (MB)'))
+    for size in sizes:
+        path = os.path.join(scratch, 'bench_%s.mrc' % size)
+        write_mrc(path, size)
+
+        def read():
+            with util.open_mrc(path) as mrc:
+                return np.array(util.get_section(mrc))
+
+        read_time, _ = measure(read, repeat=repeat)
+        img = read()
+        histeq_time, peak = measure(util.hist_equalize, img, repeat=repeat)
+        print("%-8s %12.3f %12.3f %12.1f" % (size, read_time, histeq_time, peak / 2 ** 20))
+        record('load', size, read_s=read_time, histeq_s=histeq_time, peak_mb=peak / 2 ** 20)
+        os.remove(path)
+
+
+def bench_parse(counts, repeat, scratch):
+    print("%-8s %-6s %12s %12s %12s" % ('boxes', 'format', 'parse (s)', 'peak (MB)', 'file (MB)'))
+    for n in counts:
+        for ext in BOX_EXTS:
+            path = os.path.join(scratch, 'bench' + ext)
+            write_boxfile(path, n)
+            elapsed, peak = measure(util.parse_boxfile, path, os.path.basename(path), BOXSIZE, repeat=repeat)
+            file_mb = os.path.getsize(path) / 2 ** 20
+            print("%-8s %-6s %12.3f %12.1f %12.1f" % (n, ext, elapsed, peak / 2 ** 20, file_mb))
+            record('parse', '%s %s' % (n, ext), parse_s=elapsed, peak_mb=peak / 2 ** 20)
+            os.remove(path)
+
+
+# time filtering and trace building of a parsed table, and the size of the figure JSON sent to the browser
+def bench_figure(counts, repeat, scratch):
+    print("%-8s %12s %12s %12s %12s" % ('boxes', 'filter (s)', 'traces (s)', 'peak (MB)', 'JSON (MB)'))
+    for n in counts:
+        path = os.path.join(scratch, 'bench.cbox')
+        write_boxfile(path, n)
+        df = util.parse_boxfile(path, 'bench.cbox', None)
+        os.remove(path)
+        filter_time, _ = measure(util.filter_df, df, 50, [20, 80], repeat=repeat)
+        trace_time, peak = measure(util.make_trace, df, '#ff7f00', 'bench.cbox', 'hash', repeat=repeat)
+        fig = go.Figure(data=util.make_trace(df, '#ff7f00', 'bench.cbox', 'hash'))
+        json_mb = len(pio.to_json(fig, validate=False)) / 2 ** 20
+        print("%-8s %12.4f %12.3f %12.1f %12.1f" % (n, filter_time, trace_time, peak / 2 ** 20, json_mb))
+        record('figure', n, filter_s=filter_time, traces_s=trace_time, peak_mb=peak / 2 ** 20, json_mb=json_mb)
+
+
+# post a callback request to the app's dispatch route the way the browser does, returning the response
+# (outputs are (id, property) pairs, inputs and state {(id, property): value})
+def dispatch(client, outputs, inputs, state, changed):
+    output_ids = [{'id': i, 'property': p} for i, p in outputs]
+    body = {'output': '..%s..' % '...'.join('%s.%s' % o for o in outputs) if len(outputs) > 1 else
+            '%s.%s' % outputs[0],
+            'outputs': output_ids if len(outputs) > 1 else output_ids[0],
+            'inputs': [{'id': i, 'property': p, 'value': v} for (i, p), v in inputs.items()],
+            'state': [{'id': i, 'property': p, 'value': v} for (i, p), v in state.items()],
+            'changedPropIds': changed}
+    response = client.post('/_dash-update-component', json=body)
+    if response.status_code != 200:
+        raise RuntimeError('callback failed with status %s' % response.status_code)
+    return json.loads(response.data)['response'], len(response.data)
+
+
+# load micrograph bench.mrc of an upload through load_micrograph (polling its render job like the browser does)
+# and then its boxes (bench.cbox) through store_box, returning the time of each step and the bytes sent back
+def load_upload(client, upload_id):
+    mic_outputs = [('micrograph-memory', 'data'), ('mrc-name', 'children'), ('job-memory', 'data'),
+                   ('job-poll', 'disabled'), ('job-progress', 'children')]
+    mic_inputs = {('upload-image', 'isCompleted'): True, ('contrast-mode', 'value'): 'histeq',
+                  ('stack-mode', 'value'): 'frame', ('frame-slider', 'value'): 0, ('frame-range', 'value'): [0, 0],
+                  ('bin-mode', 'value'): 'mean', ('bin-factor', 'value'): 1, ('graph-size', 'data'): 1024,
+                  ('session-memory', 'data'): None, ('job-poll', 'n_intervals'): 0}
+    mic_state = {('upload-image', 'fileNames'): ['bench.mrc'], ('upload-image', 'upload_id'): upload_id,
+                 ('job-memory', 'data'): {}, ('manual-boxsize', 'value'): ''}
+    start = time.perf_counter()
+    response, mic_sent = dispatch(client, mic_outputs, mic_inputs, mic_state, ['upload-image.isCompleted'])
+    mic_state[('job-memory', 'data')] = response['job-memory']['data']
+    while 'micrograph-memory' not in response:
+        if response['job-poll']['disabled']:
+            raise RuntimeError('rendering failed: %s' % response['job-progress']['children'])
+        time.sleep(0.05)
+        response, mic_sent = dispatch(client, mic_outputs, mic_inputs, mic_state, ['job-poll.n_intervals'])
+    mic_time = time.perf_counter() - start
+
+    box_outputs = [('boxfile-memory', 'data'), ('manual-boxsize-title', 'children'), ('micrograph', 'figure'),
+                   ('overlay-arrays', 'data')]
+    box_inputs = {('upload-box', 'isCompleted'): True, ('apply-btn', 'n_clicks'): None,
+                  ('micrograph-memory', 'data'): response['micrograph-memory']['data'],
+                  ('micrograph', 'relayoutData'): None, ('live-filter', 'value'): ['live']}
+    box_state = {('upload-box', 'fileNames'): ['bench.cbox'], ('upload-box', 'upload_id'): upload_id,
+                 ('manual-boxsize', 'value'): '',
+                 ('boxfile-memory', 'data'): {'boxfile-counter': 0, 'boxinfo': {}, 'filenames': {}, 'filehashes': {},
+                                              'viewport': None},
+                 ('micrograph', 'figure'): {'data': [], 'layout': {}}, ('box-percent-slider', 'value'): 100,
+                 ('conf-range-slider', 'value'): [0, 100], ('no-conf-boxes-switch', 'on'): True}
+    start = time.perf_counter()
+    _, box_sent = dispatch(client, box_outputs, box_inputs, box_state, ['upload-box.isCompleted'])
+    return mic_time, time.perf_counter() - start, mic_sent + box_sent
+
+
+# time loading uploads end to end with a cold render cache (a micrograph never rendered before) and a warm one,
+# then load them once more under tracemalloc for peak memory (tracing slows Python down too much to time it)
+# renders and tables go to the scratch directory
+def bench_end_to_end(sizes, n_boxes, scratch):
+    os.environ['RENDER_CACHE_ROOT'] = os.path.join(scratch, 'renders')  # also read by the render processes
+    import app
+    import boxstore
+    import jobs
+    app.UPLOAD_ROOT = scratch
+    boxstore.BOX_STORE_ROOT = os.path.join(scratch, 'boxes')
+    client = app.server.test_client()
+
+    print("%-8s %-6s %12s %12s %12s %12s" % ('size', 'cache', 'mrc (s)', 'boxes (s)', 'peak (MB)', 'sent (MB)'))
+    for size in sizes:
+        upload_dir = os.path.join(scratch, 'bench-%s' % size)
+        os.makedirs(upload_dir, exist_ok=True)
+        write_boxfile(os.path.join(upload_dir, 'bench.cbox'), n_boxes, size=size)
+        for cache in ['cold', 'warm']:
+            runs = []
+            for traced in [False, True]:
+                if cache == 'cold':  # unseeded new pixel data, so it's not in the render cache
+                    write_mrc(os.path.join(upload_dir, 'bench.mrc'), size, seed=None)
+                boxstore._lru.clear()
+                if traced:
+                    tracemalloc.start()
+                runs.append(load_upload(client, os.path.basename(upload_dir)))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            mic_time, box_time, sent = runs[0]
+            print("%-8s %-6s %12.3f %12.3f %12.1f %12.2f" % (size, cache, mic_time, box_time, peak / 2 ** 20,
+                                                             sent / 2 ** 20))
+            record('e2e', '%s %s' % (size, cache), mrc_s=mic_time, boxes_s=box_time, peak_mb=peak / 2 ** 20,
+                   sent_mb=sent / 2 ** 20)
+
+    jobs.get_pool().shutdown()  # render processes are only counted once they have exited
+    jobs._pool = None
+    print("peak memory above is this process only, render processes peaked at %.1f MB RSS" %
+          (resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 2 ** 10))
+
+
+# resident and private (not shared with a parent it was forked from) memory of this process in bytes, from
+# /proc/self/smaps_rollup on Linux (elsewhere peak RSS, and private memory is unknown)
+def get_memory():
+    try:
+        with open('/proc/self/smaps_rollup', mode='r') as f:
+            fields = {line.split(':')[0]: int(line.split()[1]) * 1024 for line in f if line.endswith('kB\n')}
+    except OSError:
+        return {'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+                'private': None}
+    return {'rss': fields['Rss'], 'private': fields['Private_Clean'] + fields['Private_Dirty']}
+
+
+# run STARTUP_PROBE in a fresh interpreter (with extra interpreter options) and return its results and stderr
+def run_startup_probe(options=()):
+    probe = subprocess.run([sys.executable] + list(options) + ['-c', STARTUP_PROBE], capture_output=True,
+                           cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True)
+    if probe.returncode != 0:
+        raise RuntimeError('startup probe failed:\n%s' % probe.stderr)
+    return json.loads(probe.stdout.splitlines()[-1]), probe.stderr
+
+
+# time importing the app in fresh interpreters (best of repeat) and measure the resulting RSS, which is what each
+# worker costs when it imports the app itself, and the private memory of a worker forked after the import once it
+# has served the page, which is what it costs with --preload (the rest stays shared with the master)
+# then list the slowest imports (python -X importtime) and heavy modules that were loaded anyway
+def bench_startup(repeat):
+    runs = [run_startup_probe()[0] for _ in range(repeat)]
+    import_s = min(run['import_s'] for run in runs)
+    rss_mb = runs[-1]['master']['rss'] / 2 ** 20
+    worker = runs[-1]['worker']
+    private_mb = worker['private'] / 2 ** 20 if worker['private'] is not None else float('nan')
+    print("%12s %12s %22s" % ('import (s)', 'RSS (MB)', 'preloaded worker (MB)'))
+    print("%12.3f %12.1f %22.1f" % (import_s, rss_mb, private_mb))
+    record('startup', 'app', import_s=import_s, rss_mb=rss_mb, worker_private_mb=private_mb)
+
+    # -X importtime lines are 'import time: self [us] | cumulative [us] | name', nested imports indented below it
+    imports = []
+    for line in run_startup_probe(['-X', 'importtime'])[1].splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and fields[2].startswith('   ') and not fields[2].startswith('    '):
+            imports.append((int(fields[1]) / 1e6, fields[2].strip()))  # imported by the app itself
+    print("slowest imports: %s" % ', '.join('%s %.3fs' % (name, t) for t, name in
+                                            sorted(imports, reverse=True)[:IMPORT_REPORT_TOP]))
+    print("heavy modules in a worker: %s" % (', '.join(worker['heavy']) or 'none'))
+
+
+# print results that got slower (or larger) than in a baseline saved with --save
+def compare_results(baseline_path):
+    with open(baseline_path, mode='r') as f:
+        baseline = {(row['bench'], row['case']): row for row in json.load(f)}
+    regressions = 0
+    for row in results:
+        old = baseline.get((row['bench'], row['case']))
+        for name, value in row.items() if old is not None else []:
+            if name in ['bench', 'case'] or not old.get(name) or value / old[name] <= REGRESSION_RATIO:
+                continue
+            regressions += 1
+            print("REGRESSION: %s %s %s %.3f -> %.3f (%.2fx)" % (row['bench'], row['case'], name, old[name], value,
+                                                                value / old[name]))
+    return regressions
+
+
+def bench_traces(counts, repeat):
+    print("%-8s %12s %12s %9s" % ('boxes', 'legacy (s)', 'numpy (s)', 'speedup'))
+    for n in counts:
+        df = make_boxes(n)
+        legacy = best_time(legacy_make_trace, df, '#ff7f00', 'bench.box', 'hash', repeat=repeat)
+        vectorized = best_time(util.make_trace, df, '#ff7f00', 'bench.box', 'hash', repeat=repeat)
+        print("%-8s %12.3f %12.3f %8.1fx" % (n, legacy, vectorized, legacy / vectorized))
+        record('traces', n, make_trace_s=vectorized)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the mrc-viewer hot paths.')
+    parser.add_argument('bench', choices=['contrast', 'traces', 'load', 'parse', 'figure', 'e2e', 'startup', 'all'],
+                        help='benchmark to run (all runs load, parse, figure, e2e and startup)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2048, 4096, 8192], help='image edge lengths')
+    parser.add_argument('--counts', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='box counts')
+    parser.add_argument('--boxes', type=int, default=10000, help='boxes loaded in the e2e benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement (best is reported)')
+    parser.add_argument('--save', help='write results to this JSON file (e.g. as a baseline)')
+    parser.add_argument('--compare', help='report regressions against results saved with --save')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='mrc-viewer-bench-')
+    try:
+        if args.bench == 'contrast':
+            bench_contrast(args.sizes, args.repeat)
+        elif args.bench == 'traces':
+            bench_traces(args.counts, args.repeat)
+        if args.bench in ['load', 'all']:
+            bench_load(args.sizes, args.repeat, scratch)
+        if args.bench in ['parse', 'all']:
+            bench_parse(args.counts, args.repeat, scratch)
+        if args.bench in ['figure', 'all']:
+            bench_figure(args.counts, args.repeat, scratch)
+        if args.bench in ['e2e', 'all']:
+            bench_end_to_end(args.sizes, args.boxes, scratch)
+        if args.bench in ['startup', 'all']:
+            bench_startup(args.repeat)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, mode='w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare and compare_results(args.compare):
+        exit(1)
@@ -0,0 +1,62 @@
+import numpy as np
+
+BIN_MODES = {'mean': 'Block mean', 'fourier': 'Fourier crop'}
+BIN_FACTORS = [1, 2, 3, 4, 6, 8]  # offered in addition to choosing the factor from the graph size
+BIN_ZOOM = 2  # automatic binning keeps this many binned px per screen px, so the view stays sharp zooming in a bit
+CHUNK_PX = 2 ** 22  # approximate number of input pixels processed at a time
+
+
+# binning factor that brings a micrograph of given shape down to about BIN_ZOOM times the graph width
+def get_auto_factor(shape, display_px, zoom=BIN_ZOOM):
+    return max(1, int(max(shape) // (display_px * zoom)))
+
+
+# number of rows (a multiple of factor) making up a chunk of about CHUNK_PX pixels
+def get_chunk_rows(width, factor):
+    return max(1, CHUNK_PX // (width * factor)) * factor
+
+
+# bin 2D image by factor x factor block means (edges not filling a whole block are dropped), reading a few
+# rows at a time so memory-mapped input is never loaded in full
+def block_mean(img_arr, factor):
+    h, w = img_arr.shape[0] // factor, img_arr.shape[1] // factor
+    out = np.empty((h, w), dtype=np.float32)
+    rows = get_chunk_rows(w * factor, factor)
+    for start in range(0, h * factor, rows):
+        chunk = np.asarray(img_arr[start:min(start + rows, h * factor), :w * factor], dtype=np.float32)
+        n = chunk.shape[0] // factor
+        out[start // factor:start // factor + n] = chunk.reshape(n, factor, w, factor).mean(axis=(1, 3))
+    return out
+
+
+# resample real array to m samples along its last axis by truncating its spectrum (keeps the mean)
+def crop_spectrum(arr, m):
+    n = arr.shape[-1]
+    spectrum = np.fft.rfft(arr, axis=-1)[..., :m // 2 + 1]
+    return (np.fft.irfft(spectrum, n=m, axis=-1) * (m / n)).astype(np.float32)
+
+
+# bin 2D image by factor through Fourier cropping, which low-passes at the new Nyquist frequency instead of
+# averaging blocks; the 2D crop is separable, so rows and then columns are resampled a chunk at a time
+def fourier_crop(img_arr, factor):
+    h, w = img_arr.shape[0] // factor * factor, img_arr.shape[1] // factor * factor
+    rows_binned = np.empty((h, w // factor), dtype=np.float32)
+    rows = get_chunk_rows(w, 1)
+    for start in range(0, h, rows):
+        rows_binned[start:start + rows] = crop_spectrum(np.asarray(img_arr[start:min(start + rows, h), :w],
+                                                                   dtype=np.float32), w // factor)
+
+    out = np.empty((h // factor, w // factor), dtype=np.float32)
+    cols = get_chunk_rows(h, 1)
+    for start in range(0, w // factor, cols):
+        out[:, start:start + cols] = crop_spectrum(rows_binned[:, start:start + cols].T, h // factor).T
+    return out
+
+
+# bin 2D image by factor using one of BIN_MODES (returned as is for factor 1)
+def bin_image(img_arr, mode='mean', factor=1):
+    if factor <= 1:
+        return img_arr
+    if mode == 'fourier':
+        return fourier_crop(img_arr, factor)
+    return block_mean(img_arr, factor)
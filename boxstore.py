@@ -0,0 +1,179 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import analytics
+import spatial
+import util
+
+BOX_STORE_ROOT = os.path.join('cache', 'boxes')
+BOX_STORE_VERSION = 2  # bump when the stored table layout changes so old tables are parsed again
+BOX_STORE_MAX_BYTES = int(os.environ.get('BOX_STORE_MAX_MB', 5000)) * 2 ** 20
+BOX_STORE_EVICT_INTERVAL_S = 60  # the store is checked against BOX_STORE_MAX_BYTES at most this often per process
+LRU_SIZE = 16  # parsed coordinate tables kept in memory per process
+
+_lru = OrderedDict()
+_grids = OrderedDict()
+_views = OrderedDict()
+_trees = OrderedDict()
+_stats = OrderedDict()
+_lock = threading.Lock()  # caches are shared with prefetch threads
+_last_evict = 0.0
+
+
+def get_path(filehash):
+    return os.path.join(BOX_STORE_ROOT, '%s.v%s.npz' % (filehash, BOX_STORE_VERSION))
+
+
+def _remember(filehash, value, cache=_lru):
+    with _lock:
+        cache[filehash] = value
+        cache.move_to_end(filehash)
+        while len(cache) > LRU_SIZE:
+            cache.popitem(last=False)
+
+
+def _recall(filehash, cache=_lru):
+    with _lock:
+        if filehash not in cache:
+            return None
+        cache.move_to_end(filehash)
+        return cache[filehash]
+
+
+# save parsed coordinate table under its file hash (numeric columns as NumPy arrays in an .npz file)
+def put(filehash, df):
+    os.makedirs(BOX_STORE_ROOT, exist_ok=True)
+    df = df.select_dtypes('number')
+    df.columns = [str(col) for col in df.columns]
+    tmp_path = get_path(filehash) + '.tmp%s-%s' % (os.getpid(), threading.get_ident())
+    with open(tmp_path, mode='wb') as f:  # write then rename so other workers never see a partial file
+        np.savez(f, **{col: df[col].to_numpy() for col in df.columns})
+    os.replace(tmp_path, get_path(filehash))
+    evict_if_due()
+    with _lock:
+        _grids.pop(filehash, None)
+        _trees.pop(filehash, None)
+        for cache in [_views, _stats]:
+            for derived_key in [k for k in cache if k[0] == filehash]:
+                del cache[derived_key]
+    _remember(filehash, df)
+
+
+# load coordinate table for file hash (None if it was never stored or has been removed), marking it as recently
+# used
+def get(filehash):
+    try:
+        os.utime(get_path(filehash))  # mtime of the table file is the LRU clock
+    except OSError:  # evicted (this process may still have it in memory)
+        pass
+    df = _recall(filehash)
+    if df is not None:
+        return df
+    try:
+        with np.load(get_path(filehash), allow_pickle=False) as npz:
+            df = pd.DataFrame({col: npz[col] for col in npz.files})
+    except (OSError, ValueError):
+        return None
+    _remember(filehash, df)
+    return df
+
+
+# remove least recently used tables until the store fits max_bytes (safe to run from several processes at once,
+# tables they still need are parsed again)
+def evict(max_bytes=BOX_STORE_MAX_BYTES):
+    entries = []
+    for name in os.listdir(BOX_STORE_ROOT):
+        try:
+            stat = os.stat(os.path.join(BOX_STORE_ROOT, name))
+        except OSError:  # removed in the meantime
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(BOX_STORE_ROOT, name))
+        except OSError:
+            pass
+        total -= size
+
+
+def evict_if_due():
+    global _last_evict
+    if time.time() - _last_evict >= BOX_STORE_EVICT_INTERVAL_S:
+        _last_evict = time.time()
+        evict()
+
+
+# grid spatial index over the box centers of a stored table (built once per table in each process)
+def get_grid(filehash):
+    grid = _recall(filehash, cache=_grids)
+    if grid is not None:
+        return grid
+    df = get(filehash)
+    if df is None:
+        return None
+    grid = spatial.build_grid_index(df['x'].to_numpy(), df['y'].to_numpy())
+    _remember(filehash, grid, cache=_grids)
+    return grid
+
+
+# row positions of a stored table after a DataTable filter query and sort (kept, so paging doesn't redo them)
+def get_table_rows(filehash, filter_query, sort_by):
+    view_key = (filehash, filter_query or '', json.dumps(sort_by or []))
+    rows = _recall(view_key, cache=_views)
+    if rows is not None:
+        return rows
+    df = get(filehash)
+    if df is None:
+        return None
+    rows = util.query_table(df, filter_query, sort_by)
+    _remember(view_key, rows, cache=_views)
+    return rows
+
+
+# KD-tree over the box centers of a stored table (built once per table in each process)
+def get_tree(filehash):
+    tree = _recall(filehash, cache=_trees)
+    if tree is not None:
+        return tree
+    df = get(filehash)
+    if df is None:
+        return None
+    tree = analytics.build_tree(df)
+    _remember(filehash, tree, cache=_trees)
+    return tree
+
+
+# pick statistics of a stored table on a micrograph of given shape (see analytics.get_file_stats)
+def get_stats(filehash, shape=None):
+    stats_key = (filehash, 'stats', json.dumps(shape))
+    stats = _recall(stats_key, cache=_stats)
+    if stats is not None:
+        return stats
+    df = get(filehash)
+    if df is None:
+        return None
+    stats = analytics.get_file_stats(df, get_tree(filehash), shape)
+    _remember(stats_key, stats, cache=_stats)
+    return stats
+
+
+# agreement between the picks of two stored tables within radius px (see analytics.get_agreement)
+def get_agreement(filehash_a, filehash_b, radius):
+    stats_key = (filehash_a, 'agreement', filehash_b, radius)
+    agreement = _recall(stats_key, cache=_stats)
+    if agreement is not None:
+        return agreement
+    tree_a, tree_b = get_tree(filehash_a), get_tree(filehash_b)
+    if tree_a is None or tree_b is None:
+        return None
+    agreement = analytics.get_agreement(tree_a, tree_b, radius)
+    _remember(stats_key, agreement, cache=_stats)
+    return agreement
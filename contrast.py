@@ -0,0 +1,120 @@
+import math
+import numpy as np
+
+CONTRAST_MODES = {'histeq': 'Histogram equalization', 'clahe': 'CLAHE', 'percentile': 'Percentile clip'}
+CHUNK_ROWS = 512  # rows of pixel data processed at a time
+SAMPLE_PX = 2 ** 20  # approximate number of pixels sampled to estimate histograms
+MAX_BINS = 4096  # cap on histogram bins (lookup table size) for float images
+CLAHE_GRID = 8  # CLAHE tiles along each axis
+CLAHE_CLIP = 2.0  # CLAHE histogram clip limit, relative to a flat histogram
+
+
+# strided subsample of a 2D array containing roughly max_px pixels
+def sample_pixels(img_arr, max_px=SAMPLE_PX):
+    step = max(1, int(math.ceil(math.sqrt(img_arr.size / max_px))))
+    return np.asarray(img_arr[::step, ::step], dtype=np.float32).ravel()
+
+
+# map values in [lo, hi] onto integer bins 0..n_bins-1 (values outside are clipped), reusing buf/idx buffers
+def quantize(values, lo, hi, n_bins, buf=None, idx=None):
+    scale = n_bins / (hi - lo) if hi > lo else 0.0
+    buf = np.subtract(values, lo, out=buf, dtype=np.float32)
+    np.multiply(buf, scale, out=buf)
+    np.clip(buf, 0, n_bins - 1, out=buf)
+    if idx is None:
+        idx = np.empty(buf.shape, dtype=np.intp)
+    np.copyto(idx, buf, casting='unsafe')  # truncates to bin index
+    return idx
+
+
+# write lut[quantized pixel] into uint8 out one row chunk at a time, never holding a full-size float copy
+def apply_lut(img_arr, lut, lo, hi, out=None):
+    if out is None:
+        out = np.empty(img_arr.shape, dtype=np.uint8)
+    rows = min(CHUNK_ROWS, img_arr.shape[0])
+    buf = np.empty((rows, img_arr.shape[1]), dtype=np.float32)
+    idx = np.empty((rows, img_arr.shape[1]), dtype=np.intp)
+    for start in range(0, img_arr.shape[0], rows):
+        n = min(rows, img_arr.shape[0] - start)
+        buf[:n] = img_arr[start:start + n]
+        quantize(buf[:n], lo, hi, len(lut), buf=buf[:n], idx=idx[:n])
+        np.take(lut, idx[:n], out=out[start:start + n])
+    return out
+
+
+# histogram bins for an image: one bin per value for integer images with a small range,
+# otherwise the bin count numpy's 'auto' rule picks for the sample (capped at MAX_BINS)
+def get_bins(img_arr, sample):
+    lo, hi = float(sample.min()), float(sample.max())
+    if np.issubdtype(img_arr.dtype, np.integer) and hi - lo < 2 ** 16:
+        return lo, hi + 1, int(hi - lo) + 1
+    n_bins = len(np.histogram_bin_edges(sample, bins='auto')) - 1
+    return lo, hi, int(min(max(n_bins, 256), MAX_BINS))
+
+
+# histogram equalization of 2D image array into uint8 out (allocated if None)
+# the histogram is estimated from a strided sample and turned into a uint8 lookup table
+def equalize(img_arr, out=None):
+    sample = sample_pixels(img_arr)
+    lo, hi, n_bins = get_bins(img_arr, sample)
+    hist = np.bincount(quantize(sample, lo, hi, n_bins).ravel(), minlength=n_bins)
+    cdf = hist.cumsum()  # cumulative distribution function
+    lut = np.round(255 * cdf / cdf[-1]).astype(np.uint8)
+    return apply_lut(img_arr, lut, lo, hi, out=out)
+
+
+# linear contrast stretch of 2D image array into uint8 out, clipping below/above the given percentiles
+def percentile_clip(img_arr, out=None, low=0.5, high=99.5):
+    lo, hi = np.percentile(sample_pixels(img_arr), [low, high])
+    lut = np.arange(256, dtype=np.uint8)
+    return apply_lut(img_arr, lut, float(lo), float(hi), out=out)
+
+
+# contrast limited adaptive histogram equalization of 2D image array into uint8 out
+# the image is first percentile-clipped to uint8 (in out), then each tile's clipped histogram is turned into
+# a lookup table and pixels are bilinearly interpolated between the tables of the 4 nearest tile centers
+def clahe(img_arr, out=None, grid=CLAHE_GRID, clip_limit=CLAHE_CLIP):
+    out = percentile_clip(img_arr, out=out, low=0.1, high=99.9)
+    h, w = out.shape
+    tile_h, tile_w = int(math.ceil(h / grid)), int(math.ceil(w / grid))
+    grid_y, grid_x = int(math.ceil(h / tile_h)), int(math.ceil(w / tile_w))
+    col_tiles = np.arange(w) // tile_w
+
+    luts = np.empty((grid_y, grid_x, 256), dtype=np.float32)
+    for ty in range(grid_y):
+        band = out[ty * tile_h:(ty + 1) * tile_h]
+        hist = np.bincount((col_tiles * 256 + band).ravel(), minlength=grid_x * 256).reshape(grid_x, 256)
+        tile_px = band.shape[0] * np.bincount(col_tiles, minlength=grid_x)
+        limit = np.maximum(clip_limit * tile_px / 256, 1)[:, None]
+        excess = np.maximum(hist - limit, 0).sum(axis=1, keepdims=True)
+        hist = np.minimum(hist, limit) + excess / 256  # redistribute clipped counts evenly
+        cdf = hist.cumsum(axis=1)
+        luts[ty] = 255 * cdf / cdf[:, -1:]
+    luts = luts.reshape(-1)
+
+    # tile-center interpolation coordinates along one axis (index of lower tile, upper tile and weight)
+    def interp_coords(n, tile_n, grid_n):
+        pos = np.clip((np.arange(n, dtype=np.float32) + 0.5) / tile_n - 0.5, 0, grid_n - 1)
+        lower = np.floor(pos).astype(np.intp)
+        return lower, np.minimum(lower + 1, grid_n - 1), pos - lower
+
+    x0, x1, wx = interp_coords(w, tile_w, grid_x)
+    y0, y1, wy = interp_coords(h, tile_h, grid_y)
+    for start in range(0, h, CHUNK_ROWS):
+        rows = slice(start, start + CHUNK_ROWS)
+        vals = out[rows].astype(np.intp)
+        top = (1 - wx) * luts[(y0[rows, None] * grid_x + x0) * 256 + vals] + \
+            wx * luts[(y0[rows, None] * grid_x + x1) * 256 + vals]
+        bottom = (1 - wx) * luts[(y1[rows, None] * grid_x + x0) * 256 + vals] + \
+            wx * luts[(y1[rows, None] * grid_x + x1) * 256 + vals]
+        out[rows] = (1 - wy[rows, None]) * top + wy[rows, None] * bottom + 0.5
+    return out
+
+
+# apply contrast mode (a key of CONTRAST_MODES) to 2D image array, returning uint8 array
+def apply_contrast(img_arr, mode='histeq', out=None):
+    if mode == 'clahe':
+        return clahe(img_arr, out=out)
+    elif mode == 'percentile':
+        return percentile_clip(img_arr, out=out)
+    return equalize(img_arr, out=out)
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import binning
+import contrast
+import metrics
+import rendercache
+import tiles
+import util
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # preprocessing processes per server process
+JOB_STALE_S = 600  # a job whose status hasn't changed for this long is assumed dead and may be resubmitted
+JOB_STATUS = 'status.json'
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+_submit_lock = threading.Lock()  # prefetch threads and callbacks may submit the same job at once
+
+
+# process pool for preprocessing jobs, created on first use so nothing is forked before workers are (--preload)
+def get_pool():
+    global _pool
+    with _pool_lock:  # also submitted to from prefetch threads
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=metrics.configure_logging)
+    return _pool
+
+
+# drop a pool that broke (a render process was killed, e.g. by the OOM killer), the next get_pool starts a new one
+def discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+
+
+# a pool (and lock) inherited through a fork belongs to the parent, the child starts its own on first use
+def reset_pool():
+    global _pool, _pool_lock, _submit_lock
+    _pool, _pool_lock, _submit_lock = None, threading.Lock(), threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_pool)
+
+
+# what a job renders: the content hash of the mrc if it's known, otherwise its size and mtime, so a file
+# replaced under the same name gets a new job
+def get_content_id(mrc_path, content_hash=None):
+    if content_hash is not None:
+        return content_hash
+    stat = os.stat(mrc_path)
+    return '%s-%s' % (stat.st_size, stat.st_mtime_ns)
+
+
+# directory tracking the job that renders an uploaded micrograph (contents identified by content_id, see
+# get_content_id) with given parameters (next to the upload)
+def get_job_dir(upload_root, upload_id, filename, params, content_id):
+    job_str = json.dumps({'content': content_id, 'params': params}, sort_keys=True)
+    params_hash = hashlib.sha1(job_str.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(upload_root, upload_id, '%s_%s_render' % (os.path.splitext(filename)[0], params_hash))
+
+
+# render parameters that actually apply to an mrc: stack options are dropped for single micrographs,
+# frame numbers are clipped to the stack and an automatic binning factor is resolved from the graph width,
+# so equivalent requests share a cache entry
+def normalize_params(mrc, params):
+    normalized = {'contrast': params['contrast']}
+    n = util.get_n_sections(mrc)
+    if n > 1:
+        first, last = sorted(min(max(int(f), 0), n - 1) for f in params.get('frames', (0, 0)))
+        mode = params.get('stack', 'frame')
+        normalized.update({'stack': mode, 'frames': [first, first if mode == 'frame' else last]})
+
+    factor = params.get('bin_factor', 1)
+    if factor == 'auto':
+        factor = binning.get_auto_factor(mrc.data.shape[-2:], params.get('display_px') or tiles.DISPLAY_PX)
+    if params.get('bin', 'none') in binning.BIN_MODES and int(factor) > 1:
+        normalized.update({'bin': params['bin'], 'bin_factor': int(factor)})
+    return normalized
+
+
+# write job status into its directory (shared by all server processes), key names the finished render
+def set_status(job_dir, state, progress=0.0, stage='', error=None, key=None):
+    os.makedirs(job_dir, exist_ok=True)
+    status = {'state': state, 'progress': progress, 'stage': stage, 'error': error, 'key': key,
+              'updated': time.time()}
+    tmp_path = os.path.join(job_dir, JOB_STATUS + '.tmp%s-%s' % (os.getpid(), threading.get_ident()))
+    with open(tmp_path, mode='w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, os.path.join(job_dir, JOB_STATUS))
+
+
+# read job status (state is None if never submitted, or if its render has since been evicted from the cache)
+def get_status(job_dir):
+    try:
+        with open(os.path.join(job_dir, JOB_STATUS), mode='r') as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        status = None
+    if status is None or (status['state'] == 'done' and rendercache.lookup(status['key']) is None):
+        return {'state': None, 'progress': 0.0, 'stage': '', 'error': None, 'key': None}
+    return status
+
+
+# preprocessing pipeline for one micrograph (runs in a pool process): content hash (unless it's known already)
+# and cache lookup, frame selection or summing for stacks, binning, contrast, tile/PNG encode into the render cache
+# (returns the seconds spent in each stage; render processes aren't scraped, so the caller records them)
+def render_micrograph(mrc_path, job_dir, params, content_hash=None):
+    timings = {}
+    start = time.perf_counter()
+
+    def end_stage(stage):
+        nonlocal start
+        timings[stage] = time.perf_counter() - start
+        start = time.perf_counter()
+
+    try:
+        set_status(job_dir, 'running', 0.0, 'hashing')
+        with util.open_mrc(mrc_path) as mrc:
+            params = normalize_params(mrc, params)
+            key = rendercache.get_key(content_hash or util.hash_file(mrc_path), params)
+            end_stage('hash')
+            if rendercache.lookup(key) is not None:
+                set_status(job_dir, 'done', 1.0, 'done', key=key)
+                return timings
+
+            set_status(job_dir, 'running', 0.1, 'reading frames')
+            section = util.get_stack_image(mrc, params.get('stack', 'frame'), params.get('frames', (0, 0)),
+                                           progress=lambda p: set_status(job_dir, 'running', 0.1 + 0.2 * p,
+                                                                         'summing frames'))
+            end_stage('read')
+            bin_factor = params.get('bin_factor', 1)
+            if bin_factor > 1:
+                set_status(job_dir, 'running', 0.25, 'binning %sx' % bin_factor)
+                section = binning.bin_image(section, params['bin'], bin_factor)
+                end_stage('bin')
+            set_status(job_dir, 'running', 0.3, 'adjusting contrast')
+            img_arr = contrast.apply_contrast(section, params['contrast'])
+            end_stage('contrast')
+            shape = mrc.data.shape[-2:]
+            del section
+
+        set_status(job_dir, 'running', 0.4, 'encoding tiles')
+        tmp_dir = rendercache.make_tmp_dir(key)
+        tiles.build_pyramid(img_arr, tmp_dir, progress=lambda p: set_status(job_dir, 'running', 0.4 + 0.55 * p,
+                                                                            'encoding tiles'),
+                            bin_factor=bin_factor, shape=shape)
+        rendercache.commit(tmp_dir, key)
+        end_stage('tiles')
+        set_status(job_dir, 'done', 1.0, 'done', key=key)
+        return timings
+    except Exception as e:
+        set_status(job_dir, 'error', 0.0, 'failed', error='%s: %s' % (type(e).__name__, e))
+        raise
+
+
+# queue micrograph preprocessing unless it's done, or already queued/running in any server process
+# (checking and queueing is serialized so threads of this process can't both queue a job)
+def submit_render(mrc_path, job_dir, params, content_hash=None):
+    with _submit_lock:
+        status = get_status(job_dir)
+        if status['state'] == 'done':
+            return status
+        if status['state'] in ['queued', 'running'] and time.time() - status['updated'] < JOB_STALE_S:
+            return status
+        set_status(job_dir, 'queued', 0.0, 'queued')
+        pool = get_pool()
+        try:
+            future = pool.submit(render_micrograph, str(mrc_path), job_dir, params, content_hash)
+        except BrokenProcessPool:  # broke since it was last used
+            discard_pool(pool)
+            pool = get_pool()
+            future = pool.submit(render_micrograph, str(mrc_path), job_dir, params, content_hash)
+    future.add_done_callback(lambda f: finish_render(f, pool, job_dir))
+    return get_status(job_dir)
+
+
+# record how a render job went (runs in this process when its future is done): stage timings are exported from here,
+# and render_micrograph saves its own errors, but a job whose process died (taking the pool with it) would stay
+# 'running' until it's stale
+def finish_render(future, pool, job_dir):
+    if future.cancelled():
+        return
+    e = future.exception()
+    metrics.inc(metrics.METRIC_PREFIX + 'render_jobs_total', 'Finished render jobs by outcome',
+                (('outcome', 'ok' if e is None else 'error'),))
+    if e is None:
+        for stage, seconds in future.result().items():
+            metrics.observe(metrics.METRIC_PREFIX + 'render_job_seconds', 'Wall time of render job stages', seconds,
+                            (('stage', stage),))
+        return
+    if isinstance(e, BrokenProcessPool):
+        discard_pool(pool)
+        logger.error("render process died, rendering %s failed" % job_dir)
+        set_status(job_dir, 'error', 0.0, 'failed', error='the render process died (out of memory?)')
+    elif get_status(job_dir)['state'] != 'error':
+        set_status(job_dir, 'error', 0.0, 'failed', error='%s: %s' % (type(e).__name__, e))
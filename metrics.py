@@ -0,0 +1,143 @@
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import flask
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')  # DEBUG also logs every callback step
+LOG_FORMAT = '%(levelname)s: %(message)s'
+METRIC_PREFIX = 'mrcviewer_'
+SECONDS_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+BYTES_BUCKETS = [2 ** k for k in range(10, 28, 2)]  # 1 KB to 128 MB
+DISPATCH_PATH = '/_dash-update-component'  # route all Dash callbacks are posted to
+
+# metrics are kept per process (each gunicorn worker exposes its own)
+_lock = threading.Lock()
+_counters = {}  # {(name, labels): value}
+_histograms = {}  # {(name, labels): [bucket counts, sum, count]}
+_buckets = {}  # {histogram name: bucket upper bounds}
+_help = {}  # {metric name: (type, help text)}
+
+
+def configure_logging(level=LOG_LEVEL):
+    logging.basicConfig(level=level, format=LOG_FORMAT)
+
+
+# peak resident set size of this process so far in bytes (ru_maxrss is in KB on Linux, bytes on macOS)
+def get_peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def inc(name, help_text, labels=(), value=1):
+    with _lock:
+        _help.setdefault(name, ('counter', help_text))
+        _counters[(name, labels)] = _counters.get((name, labels), 0) + value
+
+
+def observe(name, help_text, value, labels=(), buckets=SECONDS_BUCKETS):
+    with _lock:
+        _help.setdefault(name, ('histogram', help_text))
+        _buckets.setdefault(name, buckets)
+        hist = _histograms.setdefault((name, labels), [[0] * len(buckets), 0.0, 0])
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                hist[0][i] += 1
+        hist[1] += value
+        hist[2] += 1
+
+
+# record wall time, growth of the process's peak RSS and errors of every call of a function
+def instrument(fn):
+    labels = (('function', '%s.%s' % (fn.__module__, fn.__qualname__)),)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start, peak = time.perf_counter(), get_peak_rss()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            inc(METRIC_PREFIX + 'function_errors_total', 'Calls that raised', labels)
+            raise
+        finally:
+            observe(METRIC_PREFIX + 'function_seconds', 'Wall time of instrumented functions',
+                    time.perf_counter() - start, labels)
+            inc(METRIC_PREFIX + 'function_peak_rss_growth_bytes_total',
+                'Growth of the process peak RSS during calls', labels, get_peak_rss() - peak)
+    return wrapper
+
+
+# name of the callback a dispatch request is for (its function name, or its outputs if it isn't registered)
+def get_callback_name(app, body):
+    output = body.get('output', '') if isinstance(body, dict) else ''
+    callback = app.callback_map.get(output, {}).get('callback')
+    return getattr(callback, '__name__', output)
+
+
+# record wall time, serialized response size and peak RSS growth of every Dash callback from request hooks on
+# the Flask server, so callbacks don't need to be wrapped one by one
+def instrument_dash(app):
+    server = app.server
+
+    @server.before_request
+    def start_callback_metrics():
+        if flask.request.path.endswith(DISPATCH_PATH):
+            flask.g.metrics_start = (time.perf_counter(), get_peak_rss())
+
+    @server.after_request
+    def record_callback_metrics(response):
+        if 'metrics_start' not in flask.g:
+            return response
+        start, peak = flask.g.metrics_start
+        labels = (('callback', get_callback_name(app, flask.request.get_json(silent=True))),)
+        observe(METRIC_PREFIX + 'callback_seconds', 'Wall time of Dash callbacks', time.perf_counter() - start,
+                labels)
+        observe(METRIC_PREFIX + 'callback_response_bytes', 'Serialized size of Dash callback responses',
+                response.calculate_content_length() or 0, labels, buckets=BYTES_BUCKETS)
+        inc(METRIC_PREFIX + 'callback_peak_rss_growth_bytes_total',
+            'Growth of the process peak RSS during Dash callbacks', labels, get_peak_rss() - peak)
+        inc(METRIC_PREFIX + 'callback_responses_total', 'Dash callback responses by HTTP status',
+            labels + (('status', str(response.status_code)),))
+        return response
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s=%s' % (k, json.dumps(str(v))) for k, v in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+# all metrics in the Prometheus text exposition format
+def get_metrics_text():
+    lines = []
+    with _lock:
+        inc_items = sorted(_counters.items())
+        hist_items = sorted((key, [list(hist[0]), hist[1], hist[2]]) for key, hist in _histograms.items())
+        help_items = dict(_help)
+        buckets = dict(_buckets)
+
+    described = set()
+    for (name, labels), value in inc_items:
+        if name not in described:
+            described.add(name)
+            lines.extend(['# HELP %s %s' % (name, help_items[name][1]), '# TYPE %s counter' % name])
+        lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+    for (name, labels), (counts, total, count) in hist_items:
+        if name not in described:
+            described.add(name)
+            lines.extend(['# HELP %s %s' % (name, help_items[name][1]), '# TYPE %s histogram' % name])
+        for bound, bucket_count in zip(buckets[name], counts):
+            lines.append('%s_bucket%s %s' % (name, format_labels(labels + (('le', format_value(bound)),)),
+                                              bucket_count))
+        lines.append('%s_bucket%s %s' % (name, format_labels(labels + (('le', '+Inf'),)), count))
+        lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(total)))
+        lines.append('%s_count%s %s' % (name, format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,198 @@
+import argparse
+import logging
+import math
+import multiprocessing
+import os
+import numpy as np
+from PIL import Image, ImageDraw
+import binning
+import contrast
+import metrics
+import session
+import util
+
+THUMB_PX = 1024  # longest edge of rendered thumbnails
+SHEET_COLS = 6
+SHEET_ROWS = 5
+SHEET_LABEL_PX = 16  # strip under each contact sheet cell holding the micrograph name
+BOX_LINE_PX = 2
+PROGRESS_EVERY = 100  # micrographs between progress messages
+STAR_INDEX_DIR = '.star-index'  # in the output directory (the dataset may be read-only)
+
+logger = logging.getLogger(__name__)
+
+
+def hex_to_rgb(color):
+    return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+
+
+# concatenated inclusive ranges starts[i]..stops[i] (all non-empty)
+def concat_ranges(starts, stops):
+    lengths = stops - starts + 1
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(lengths.sum()) + offsets
+
+
+# draw outlines of boxes (pixel bounds, may reach past the image) into an RGB image, all boxes at once:
+# the pixels of every visible edge are generated with NumPy and set in one fancy-indexing assignment
+def draw_boxes(rgb, x0, y0, x1, y1, color, line_px=BOX_LINE_PX):
+    h, w = rgb.shape[:2]
+    x0, y0 = np.floor(x0).astype(np.intp), np.floor(y0).astype(np.intp)
+    x1, y1 = np.ceil(x1).astype(np.intp), np.ceil(y1).astype(np.intp)
+    visible = (x1 >= 0) & (x0 < w) & (y1 >= 0) & (y0 < h)
+    x0, y0, x1, y1 = x0[visible], y0[visible], x1[visible], y1[visible]
+    cx0, cx1 = np.clip(x0, 0, w - 1), np.clip(x1, 0, w - 1)
+    cy0, cy1 = np.clip(y0, 0, h - 1), np.clip(y1, 0, h - 1)
+
+    rows = []
+    cols = []
+    for t in range(line_px):
+        for edge_y in (y0 + t, y1 - t):  # horizontal edges
+            inside = (edge_y >= 0) & (edge_y < h)
+            rows.append(np.repeat(edge_y[inside], cx1[inside] - cx0[inside] + 1))
+            cols.append(concat_ranges(cx0[inside], cx1[inside]))
+        for edge_x in (x0 + t, x1 - t):  # vertical edges
+            inside = (edge_x >= 0) & (edge_x < w)
+            rows.append(concat_ranges(cy0[inside], cy1[inside]))
+            cols.append(np.repeat(edge_x[inside], cy1[inside] - cy0[inside] + 1))
+    rgb[np.concatenate(rows), np.concatenate(cols)] = color
+
+
+# coordinate table of one micrograph from a coordinate file (STAR files covering many micrographs are read with
+# their index from index_star_files)
+def load_boxes(path, mic_stem, manual_boxsize, star_index=None):
+    if star_index is not None:
+        return util.read_star_micrograph(path, star_index, mic_stem, os.path.basename(path), manual_boxsize)
+    return util.parse_boxfile(path, os.path.basename(path), manual_boxsize)
+
+
+# indexes of the STAR files naming more than one micrograph (read per micrograph, others are parsed whole) among
+# the coordinate files of items, each built once and cut down to the rows of every item's micrograph so tasks
+# don't carry the whole index
+# returns [{path: index}] in item order
+def index_star_files(items, index_root):
+    indexes = {}
+    for path in sorted({p for item in items for p in item['boxfiles'] if p.lower().endswith('.star')}):
+        try:
+            index = util.index_star(path, index_root)
+        except OSError as e:
+            logger.warning("could not index %s (%s)" % (path, e))
+            continue
+        if len(index['micrographs']) > 1:
+            indexes[path] = index
+    return [{path: {'loops': indexes[path]['loops'],
+                    'micrographs': {item['stem']: indexes[path]['micrographs'].get(item['stem'], [])}}
+             for path in item['boxfiles'] if path in indexes} for item in items]
+
+
+# render one micrograph with its box overlays to a thumbnail image file (runs in a pool process)
+# returns (position, output path, boxes drawn, error message or None)
+def render_thumbnail(task):
+    position, item, star_indexes, out_path, opts = task
+    if not opts['overwrite'] and os.path.exists(out_path):
+        return position, out_path, None, None
+    try:
+        with util.open_mrc(item['mrc']) as mrc:
+            section = util.get_section(mrc)
+            factor = max(1, int(math.ceil(max(section.shape) / opts['size'])))
+            img_arr = binning.bin_image(section, opts['bin'], factor)
+        if opts['contrast'] == 'histeq':
+            img_arr = util.hist_equalize(img_arr)
+        else:
+            img_arr = contrast.apply_contrast(img_arr, opts['contrast'])
+        rgb = np.repeat(img_arr[:, :, None], 3, axis=2)
+
+        n_boxes = 0
+        for i, path in enumerate(item['boxfiles'] if opts['boxes'] else []):
+            df = load_boxes(path, item['stem'], opts['boxsize'], star_indexes.get(path))
+            if df is None:
+                logger.warning("%s needs a box size (--boxsize)" % path)
+                continue
+            df = util.filter_df(df, opts['percent'], opts['conf_range'], keep_no_conf=True)
+            x, y = df['x'].to_numpy() / factor, df['y'].to_numpy() / factor
+            half_w, half_h = df['w'].to_numpy() / (2 * factor), df['h'].to_numpy() / (2 * factor)
+            draw_boxes(rgb, x - half_w, y - half_h, x + half_w, y + half_h, hex_to_rgb(util.get_color(i + 1)[0]))
+            n_boxes += len(df.index)
+
+        # micrograph y runs up from the bottom, as in the viewer
+        Image.fromarray(np.ascontiguousarray(np.flipud(rgb))).save(out_path, quality=opts['quality'])
+        return position, out_path, n_boxes, None
+    except Exception as e:
+        return position, out_path, None, '%s: %s' % (type(e).__name__, e)
+
+
+# paste thumbnails (with their names underneath) into a grid of up to cols x rows cells of size px
+def make_contact_sheet(thumbs, size, cols=SHEET_COLS, rows=SHEET_ROWS):
+    rows = min(rows, int(math.ceil(len(thumbs) / cols)))  # the last sheet may be partly filled
+    sheet = Image.new('RGB', (cols * size, rows * (size + SHEET_LABEL_PX)), color=(0, 0, 0))
+    draw = ImageDraw.Draw(sheet)
+    for k, (name, path) in enumerate(thumbs):
+        left, top = (k % cols) * size, (k // cols) * (size + SHEET_LABEL_PX)
+        try:
+            with Image.open(path) as thumb:
+                thumb.thumbnail((size, size))
+                sheet.paste(thumb, (left + (size - thumb.width) // 2, top + (size - thumb.height) // 2))
+        except OSError:
+            pass  # failed render, the cell only gets its name
+        draw.text((left + 4, top + size + 2), name, fill=(255, 255, 255))
+    return sheet
+
+
+def render_directory(directory, out_dir, opts, workers, sheet_px):
+    index = session.index_directory(directory)
+    items = [dict(item, boxfiles=item['boxfiles'] + index['shared']) for item in index['items']]
+    os.makedirs(out_dir, exist_ok=True)
+    ext = 'jpg' if opts['format'] == 'jpeg' else 'png'
+    star_indexes = [{}] * len(items)
+    if opts['boxes']:
+        star_indexes = index_star_files(items, os.path.join(out_dir, STAR_INDEX_DIR))
+    tasks = [(k, item, star_indexes[k], os.path.join(out_dir, '%s.%s' % (item['stem'], ext)), opts)
+             for k, item in enumerate(items)]
+    logger.info("rendering %s micrographs from %s with %s processes" % (len(tasks), directory, workers))
+
+    thumbs = [None] * len(tasks)
+    failed = 0
+    with multiprocessing.Pool(workers) as pool:
+        for done, (position, out_path, n_boxes, error) in enumerate(pool.imap_unordered(render_thumbnail, tasks), 1):
+            thumbs[position] = (items[position]['stem'], out_path)
+            if error is not None:
+                failed += 1
+                logger.error("could not render %s (%s)" % (items[position]['mrc'], error))
+            if done % PROGRESS_EVERY == 0 or done == len(tasks):
+                logger.info("rendered %s/%s micrographs" % (done, len(tasks)))
+
+    if sheet_px:
+        per_sheet = SHEET_COLS * SHEET_ROWS
+        for start in range(0, len(thumbs), per_sheet):
+            sheet_path = os.path.join(out_dir, 'sheet_%04d.%s' % (start // per_sheet + 1, ext))
+            make_contact_sheet(thumbs[start:start + per_sheet], sheet_px).save(sheet_path, quality=opts['quality'])
+        logger.info("wrote %s contact sheets" % int(math.ceil(len(thumbs) / per_sheet)))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render micrograph thumbnails with coordinate overlays for a '
+                                                 'directory (micrographs are paired with coordinate files by stem).')
+    parser.add_argument('directory', help='directory of .mrc/.mrcs files and their coordinate files')
+    parser.add_argument('out_dir', help='directory thumbnails and contact sheets are written to')
+    parser.add_argument('--size', type=int, default=THUMB_PX, help='longest thumbnail edge in px')
+    parser.add_argument('--format', choices=['png', 'jpeg'], default='png')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality')
+    parser.add_argument('--contrast', choices=list(contrast.CONTRAST_MODES), default='histeq')
+    parser.add_argument('--bin', choices=list(binning.BIN_MODES), default='mean',
+                        help='how micrographs are binned down to the thumbnail size')
+    parser.add_argument('--boxsize', type=float, default=None, help='box size for files that don\'t give one')
+    parser.add_argument('--percent', type=int, default=100, help='percent of boxes drawn')
+    parser.add_argument('--conf', type=int, nargs=2, default=[0, 100], metavar=('LOW', 'HIGH'),
+                        help='confidence range of boxes drawn in percent (boxes without confidence are drawn)')
+    parser.add_argument('--no-boxes', dest='boxes', action='store_false', help='render micrographs only')
+    parser.add_argument('--sheet-px', type=int, default=256, help='contact sheet cell size in px (0 for none)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='rendering processes')
+    parser.add_argument('--overwrite', action='store_true', help='render thumbnails that already exist again')
+    args = parser.parse_args()
+    metrics.configure_logging()
+
+    opts = {'size': args.size, 'format': args.format, 'quality': args.quality, 'contrast': args.contrast,
+            'bin': args.bin, 'boxsize': args.boxsize, 'percent': args.percent, 'conf_range': args.conf,
+            'boxes': args.boxes, 'overwrite': args.overwrite}
+    exit(1 if render_directory(args.directory, args.out_dir, opts, args.workers, args.sheet_px) else 0)
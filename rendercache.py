@@ -0,0 +1,99 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+import tiles
+
+RENDER_CACHE_ROOT = os.environ.get('RENDER_CACHE_ROOT', os.path.join('cache', 'renders'))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_MB', 20000)) * 2 ** 20
+RENDER_VERSION = 1  # bump when the rendering pipeline changes so old entries aren't reused
+
+logger = logging.getLogger(__name__)
+
+
+# cache key for an mrc (by content hash) rendered with given parameters
+def get_key(content_hash, params):
+    key_str = json.dumps({'hash': content_hash, 'params': params, 'version': RENDER_VERSION}, sort_keys=True)
+    return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+
+def get_entry_dir(key):
+    return os.path.join(RENDER_CACHE_ROOT, key)
+
+
+# exclusive lock shared by all server and job processes using the cache root
+@contextmanager
+def cache_lock():
+    os.makedirs(RENDER_CACHE_ROOT, exist_ok=True)
+    with open(os.path.join(RENDER_CACHE_ROOT, '.lock'), mode='w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# tile pyramid metadata for a cached render (None on a miss), marking the entry as recently used
+def lookup(key):
+    entry_dir = get_entry_dir(key)
+    meta = tiles.load_meta(entry_dir)
+    if meta is not None:
+        try:
+            os.utime(os.path.join(entry_dir, tiles.TILE_META))  # mtime of the metadata file is the LRU clock
+        except OSError:  # evicted in the meantime
+            return None
+    return meta
+
+
+# private directory to render a new entry into before it's committed
+def make_tmp_dir(key):
+    tmp_dir = os.path.join(RENDER_CACHE_ROOT, '.tmp-%s-%s' % (key, os.getpid()))
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    return tmp_dir
+
+
+# total size of files under a directory in bytes
+def get_dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+# move a finished render into the cache (atomic rename, so readers never see partial entries), then evict
+def commit(tmp_dir, key):
+    meta = tiles.load_meta(tmp_dir)
+    meta['bytes'] = get_dir_bytes(tmp_dir)
+    with open(os.path.join(tmp_dir, tiles.TILE_META), mode='w') as f:
+        json.dump(meta, f)
+    with cache_lock():
+        try:
+            os.rename(tmp_dir, get_entry_dir(key))
+        except OSError:  # another process rendered the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        evict()
+
+
+# remove least recently used entries until the cache fits RENDER_CACHE_MAX_BYTES (call with cache_lock held)
+def evict(max_bytes=RENDER_CACHE_MAX_BYTES):
+    entries = []
+    for name in os.listdir(RENDER_CACHE_ROOT):
+        meta_path = os.path.join(RENDER_CACHE_ROOT, name, tiles.TILE_META)
+        if name.startswith('.') or not os.path.exists(meta_path):
+            continue
+        meta = tiles.load_meta(os.path.join(RENDER_CACHE_ROOT, name)) or {}
+        entries.append((os.path.getmtime(meta_path), meta.get('bytes', 0), name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        logger.info("evicting cached render %s (%s bytes)" % (name, size))
+        trash_dir = os.path.join(RENDER_CACHE_ROOT, '.evicted-%s' % name)
+        os.rename(os.path.join(RENDER_CACHE_ROOT, name), trash_dir)
+        shutil.rmtree(trash_dir, ignore_errors=True)
+        total -= size
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import util
+
+SESSION_DATA_ROOT = os.environ.get('SESSION_DATA_ROOT', 'data')  # sessions may only index directories under this
+SESSION_ROOT = os.path.join('cache', 'sessions')
+SESSION_INDEX = 'index.json'
+MRC_EXTS = ['.mrc', '.mrcs']
+BOX_EXTS = list(util.BOX_COLUMNS) + ['.star']
+PREFETCH_COUNT = 3  # micrographs ahead of the current one that are rendered and have their overlays parsed
+PREFETCH_WORKERS = 2
+
+logger = logging.getLogger(__name__)
+
+_indexes = {}
+_prefetch_pool = None
+_prefetched = set()
+
+
+# thread pool for prefetching, created on first use so nothing is started before workers are forked (--preload)
+def get_prefetch_pool():
+    global _prefetch_pool
+    if _prefetch_pool is None:
+        _prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+    return _prefetch_pool
+
+
+# threads don't survive a fork, so a child starts its own pool on first use
+def reset_prefetch_pool():
+    global _prefetch_pool
+    _prefetch_pool = None
+
+
+os.register_at_fork(after_in_child=reset_prefetch_pool)
+
+
+# absolute path of a session directory (None if it isn't a directory under SESSION_DATA_ROOT)
+def resolve_dir(path):
+    data_root = os.path.realpath(SESSION_DATA_ROOT)
+    path = os.path.realpath(os.path.join(data_root, path))
+    if os.path.commonpath([data_root, path]) != data_root or not os.path.isdir(path):
+        return None
+    return path
+
+
+def get_session_dir(session_id):
+    return os.path.join(SESSION_ROOT, session_id)
+
+
+# pair each micrograph in a directory with the coordinate files sharing its stem; coordinate files matching
+# no micrograph (e.g. a STAR file for the whole dataset) are shared by all micrographs
+def index_directory(path):
+    mrcs = {}
+    boxfiles = {}
+    for name in sorted(os.listdir(path)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() in MRC_EXTS:
+            mrcs.setdefault(stem, os.path.join(path, name))  # .mrc sorts before .mrcs and wins
+        elif ext.lower() in BOX_EXTS:
+            boxfiles.setdefault(stem, []).append(os.path.join(path, name))
+
+    items = [{'stem': stem, 'mrc': mrc_path, 'boxfiles': boxfiles.get(stem, [])} for stem, mrc_path in mrcs.items()]
+    shared = [p for stem, paths in boxfiles.items() if stem not in mrcs for p in paths]
+    return {'root': path, 'items': items, 'shared': shared}
+
+
+# index a directory (see index_directory) and save it as a session, returning the session id
+def open_session(path):
+    index = index_directory(path)
+    session_id = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    os.makedirs(get_session_dir(session_id), exist_ok=True)
+    tmp_path = os.path.join(get_session_dir(session_id),
+                            SESSION_INDEX + '.tmp%s-%s' % (os.getpid(), threading.get_ident()))
+    with open(tmp_path, mode='w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(get_session_dir(session_id), SESSION_INDEX))
+    _indexes[session_id] = index
+    return session_id, index
+
+
+# session index saved by open_session (None if there is no such session)
+def load_index(session_id):
+    if session_id not in _indexes:
+        try:
+            with open(os.path.join(get_session_dir(session_id), SESSION_INDEX), mode='r') as f:
+                _indexes[session_id] = json.load(f)
+        except (OSError, ValueError):
+            return None
+    return _indexes[session_id]
+
+
+# micrograph at position in a session, with the session's shared coordinate files added to its own (marks the
+# session as in use, its directory mtime is the clock the storage sweeper expires sessions by)
+def get_item(session_id, position):
+    index = load_index(session_id)
+    if index is None or not 0 <= position < len(index['items']):
+        return None
+    try:
+        os.utime(get_session_dir(session_id))
+    except OSError:
+        pass
+    item = index['items'][position]
+    return dict(item, boxfiles=item['boxfiles'] + index['shared'])
+
+
+# run load_fn(item) in the background for the PREFETCH_COUNT micrographs after position (once per item and
+# prefetch_key, so paging back and forth doesn't queue the same work again)
+def prefetch(session_id, position, load_fn, prefetch_key=''):
+    for ahead in range(position + 1, position + 1 + PREFETCH_COUNT):
+        item = get_item(session_id, ahead)
+        if item is None:
+            break
+        done_key = (session_id, ahead, prefetch_key)
+        if done_key in _prefetched:
+            continue
+        _prefetched.add(done_key)
+        get_prefetch_pool().submit(run_prefetch, load_fn, item)
+
+
+def run_prefetch(load_fn, item):
+    try:
+        load_fn(item)
+    except Exception as e:  # prefetching is best effort, the micrograph is loaded normally when navigated to
+        logger.warning("prefetching %s failed (%s: %s)" % (item['mrc'], type(e).__name__, e))
@@ -0,0 +1,74 @@
+import numpy as np
+
+GRID_CELL_PX = 256  # edge length of the grid buckets box centers are sorted into
+MAX_VISIBLE_BOXES = 20000  # above this many boxes in view, only those with the lowest sampling ranks are drawn
+CULL_MARGIN = 0.5  # fraction of the viewport drawn beyond each edge, so small pans don't need new boxes
+
+
+# bucket box centers into a square grid, returning box indices grouped by cell (order) and where each cell's
+# group starts (cell_starts[c]:cell_starts[c + 1] slices cell c out of order)
+def build_grid_index(x, y, cell_px=GRID_CELL_PX):
+    n_cols = int(np.max(x) // cell_px) + 1 if len(x) else 1
+    n_rows = int(np.max(y) // cell_px) + 1 if len(y) else 1
+    col = np.clip(x // cell_px, 0, n_cols - 1).astype(np.intp)
+    row = np.clip(y // cell_px, 0, n_rows - 1).astype(np.intp)
+    cells = row * n_cols + col
+    order = np.argsort(cells, kind='stable')
+    cell_starts = np.searchsorted(cells[order], np.arange(n_rows * n_cols + 1))
+    return {'order': order, 'cell_starts': cell_starts, 'n_cols': n_cols, 'n_rows': n_rows, 'cell_px': cell_px}
+
+
+# indices (ascending) of boxes with centers inside region [x0, x1, y0, y1] grown by pad, looked up through the grid
+def query_grid_index(grid, x, y, region, pad=0):
+    x0, x1, y0, y1 = region[0] - pad, region[1] + pad, region[2] - pad, region[3] + pad
+    cell_px, n_cols, n_rows = grid['cell_px'], grid['n_cols'], grid['n_rows']
+    col0, col1 = [int(min(max(v // cell_px, 0), n_cols - 1)) for v in (x0, x1)]
+    row0, row1 = [int(min(max(v // cell_px, 0), n_rows - 1)) for v in (y0, y1)]
+    starts = grid['cell_starts']
+    candidates = np.sort(np.concatenate([grid['order'][starts[row * n_cols + col0]:starts[row * n_cols + col1 + 1]]
+                                         for row in range(row0, row1 + 1)]))
+    cx, cy = x[candidates], y[candidates]
+    return candidates[(cx >= x0) & (cx <= x1) & (cy >= y0) & (cy <= y1)]
+
+
+# visible [x0, x1, y0, y1] from get_viewport's (x range, y range), filling autoscaled axes from the micrograph
+# shape (None if the whole micrograph is in view or its extent is unknown)
+def get_view_box(viewport, shape=None):
+    if viewport is None or viewport == (None, None):
+        return None
+    if shape is None:
+        return None
+    x_range = sorted(viewport[0]) if viewport[0] is not None else [-0.5, shape[1] - 0.5]
+    y_range = sorted(viewport[1]) if viewport[1] is not None else [-0.5, shape[0] - 0.5]
+    return [x_range[0], x_range[1], y_range[0], y_range[1]]
+
+
+# region to draw boxes for given view box: the view grown by CULL_MARGIN on each side (None draws everything)
+def get_cull_region(view_box):
+    if view_box is None:
+        return None
+    dx = (view_box[1] - view_box[0]) * CULL_MARGIN
+    dy = (view_box[3] - view_box[2]) * CULL_MARGIN
+    return [view_box[0] - dx, view_box[1] + dx, view_box[2] - dy, view_box[3] + dy]
+
+
+# whether overlay traces drawn for region (decimated or not) still fit a new view box
+# decimated traces are redrawn once zoomed in far enough that more of the boxes would fit on screen
+def can_reuse_region(region, decimated, view_box):
+    if region is None:
+        return not decimated or view_box is None
+    if view_box is None:
+        return False
+    inside = region[0] <= view_box[0] and view_box[1] <= region[1] and \
+        region[2] <= view_box[2] and view_box[3] <= region[3]
+    drawn_width = (region[1] - region[0]) / (1 + 2 * CULL_MARGIN)
+    return inside and (not decimated or view_box[1] - view_box[0] > drawn_width / 2)
+
+
+# the max_boxes rows with lowest sampling rank when there are more (returns subset, whether it was decimated)
+# ranks are stratified by confidence (util.get_sample_ranks), so the subset keeps the mix of confidences
+def decimate(boxes, max_boxes=MAX_VISIBLE_BOXES):
+    if len(boxes.index) <= max_boxes:
+        return boxes, False
+    rank = boxes['rank'].to_numpy()
+    return boxes[rank < np.partition(rank, max_boxes)[max_boxes]], True
@@ -0,0 +1,279 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import metrics
+import session
+import util
+
+UPLOAD_QUOTA_BYTES = int(os.environ.get('UPLOAD_QUOTA_MB', 50000)) * 2 ** 20  # disk space all uploads may use
+UPLOAD_TTL_S = float(os.environ.get('UPLOAD_TTL_HOURS', 24)) * 3600  # uploads unused for this long are deleted
+UPLOAD_MIN_IDLE_S = 600  # uploads used more recently than this are never evicted to make room
+SWEEP_INTERVAL_S = 600
+BLOB_DIR = '.blobs'  # one hard link per distinct upload content, named by content hash
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 2))  # threads checking completed uploads
+MRC_EXTS = ['.mrc', '.mrcs']
+CACHE_SWEEP_DIRS = [util.STAR_INDEX_ROOT, session.SESSION_ROOT]  # entries unused for UPLOAD_TTL_S are deleted too
+
+logger = logging.getLogger(__name__)
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+_upload_pool = None
+_upload_futures = {}  # {(upload file path, size, mtime): future} of uploads checked by this process
+_uploads_lock = threading.Lock()
+
+
+# exclusive lock shared by all server processes using the upload root
+@contextmanager
+def storage_lock(upload_root):
+    os.makedirs(upload_root, exist_ok=True)
+    with open(os.path.join(upload_root, '.lock'), mode='w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_blob_path(upload_root, filehash):
+    return os.path.join(upload_root, BLOB_DIR, filehash)
+
+
+# upload directories (one per page load that uploaded anything) by last use, least recently used first
+def list_uploads(upload_root):
+    uploads = []
+    for name in os.listdir(upload_root):
+        path = os.path.join(upload_root, name)
+        if not name.startswith('.') and os.path.isdir(path):
+            uploads.append((os.path.getmtime(path), name))
+    return [name for _, name in sorted(uploads)]
+
+
+# disk space used by uploads in bytes (hard links to the same blob are counted once)
+def get_usage(upload_root):
+    inodes = {}
+    for dir_path, _, names in os.walk(upload_root):
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(dir_path, name))
+            except OSError:  # removed in the meantime
+                continue
+            inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+    return sum(inodes.values())
+
+
+# delete blobs no upload links to anymore
+def collect_blobs(upload_root):
+    blob_root = os.path.join(upload_root, BLOB_DIR)
+    for name in os.listdir(blob_root) if os.path.isdir(blob_root) else []:
+        path = os.path.join(blob_root, name)
+        if os.stat(path).st_nlink == 1:
+            os.remove(path)
+
+
+def remove_upload(upload_root, upload_id, reason):
+    logger.info("removing upload %s (%s)" % (upload_id, reason))
+    metrics.inc(metrics.METRIC_PREFIX + 'upload_removals_total', 'Upload directories removed', (('reason', reason),))
+    trash_dir = os.path.join(upload_root, '.removed-%s' % upload_id)
+    os.rename(os.path.join(upload_root, upload_id), trash_dir)  # atomically gone for readers
+    shutil.rmtree(trash_dir, ignore_errors=True)
+
+
+# mark an upload as in use (its directory mtime is the LRU and TTL clock), starting the sweeper if needed
+def touch_upload(upload_root, upload_id):
+    start_sweeper(upload_root)
+    try:
+        os.utime(os.path.join(upload_root, upload_id))
+    except OSError:
+        pass
+
+
+# deduplicate a completed upload (with content hash filehash) against earlier ones and enforce the quota
+# a file seen for the first time becomes the blob for its contents, later copies are replaced by hard links to
+# it so their space is freed; uploads idle for UPLOAD_MIN_IDLE_S are evicted (least recently used first) to make
+# room, and if that isn't enough the upload is deleted again (returns whether it was kept)
+def store_upload(upload_root, upload_id, filename, filehash):
+    path = os.path.join(upload_root, upload_id, filename)
+    if os.stat(path).st_nlink > 1:  # stored before
+        return True
+    blob_path = get_blob_path(upload_root, filehash)
+    with storage_lock(upload_root):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(path, blob_path)
+        except FileExistsError:
+            if os.path.getsize(blob_path) == os.path.getsize(path):
+                tmp_path = '%s.tmp%s' % (path, os.getpid())
+                os.link(blob_path, tmp_path)
+                os.replace(tmp_path, path)
+                metrics.inc(metrics.METRIC_PREFIX + 'upload_deduplicated_bytes_total',
+                            'Disk space saved by hard linking identical uploads', value=os.path.getsize(path))
+
+        usage = get_usage(upload_root)
+        if usage > UPLOAD_QUOTA_BYTES:
+            idle_before = time.time() - UPLOAD_MIN_IDLE_S
+            for name in list_uploads(upload_root):
+                if usage <= UPLOAD_QUOTA_BYTES:
+                    break
+                if name != upload_id and os.path.getmtime(os.path.join(upload_root, name)) < idle_before:
+                    remove_upload(upload_root, name, 'quota')
+                    collect_blobs(upload_root)
+                    usage = get_usage(upload_root)
+        if usage > UPLOAD_QUOTA_BYTES:
+            logger.warning("upload quota exceeded, rejecting %s (%s bytes)" % (filename, os.path.getsize(path)))
+            os.remove(path)
+            collect_blobs(upload_root)
+            return False
+    return True
+
+
+# thread pool for checking uploads, created on first use so nothing is started before workers are forked
+def get_upload_pool():
+    global _upload_pool
+    with _uploads_lock:
+        if _upload_pool is None:
+            _upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    return _upload_pool
+
+
+# result of checking an upload, saved next to it so all server processes see it
+def get_record_path(upload_root, upload_id, filename):
+    return os.path.join(upload_root, upload_id, '.%s.json' % filename)
+
+
+# the saved record, or None if there is none or the file was replaced since (dash_uploader keeps the upload id for
+# the whole page, so a file uploaded again under the same name is rewritten in place)
+def load_record(upload_root, upload_id, filename):
+    try:
+        with open(get_record_path(upload_root, upload_id, filename), mode='r') as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        stat = os.stat(os.path.join(upload_root, upload_id, filename))
+    except OSError:  # removed (e.g. rejected for the quota), the record says why
+        return record
+    if record.get('size') != stat.st_size or record.get('mtime') != stat.st_mtime_ns:
+        return None
+    return record
+
+
+# post-process a completed upload: content hash, integrity check for micrographs, then deduplication and quota
+# (see store_upload); returns its record {'hash', 'size', 'mtime', 'error', 'warnings'} with error None if it can
+# be used, size and mtime (ns) being those of the stored file so a replaced file is checked again
+def check_upload(upload_root, upload_id, filename):
+    path = os.path.join(upload_root, upload_id, filename)
+    record = {'hash': None, 'size': None, 'mtime': None, 'error': None, 'warnings': []}
+    try:
+        record['hash'] = util.hash_file(path)
+        if os.path.splitext(filename)[-1].lower() in MRC_EXTS:
+            record['error'], record['warnings'] = util.check_mrc(path)
+            for warning in record['warnings']:
+                logger.warning("%s: %s" % (filename, warning))
+        if record['error'] is None and not store_upload(upload_root, upload_id, filename, record['hash']):
+            record['error'] = 'server storage is full, please try again later'
+        stat = os.stat(path)  # after deduplication, which may have swapped in the blob's inode
+        record['size'], record['mtime'] = stat.st_size, stat.st_mtime_ns
+    except OSError as e:
+        record['error'] = 'upload is gone (%s)' % e.strerror
+
+    record_path = get_record_path(upload_root, upload_id, filename)
+    tmp_path = record_path + '.tmp%s-%s' % (os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, mode='w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, record_path)
+    except OSError:  # upload directory expired in the meantime
+        pass
+    return record
+
+
+# record of a completed upload (see check_upload), checked in the upload pool when it's first asked for
+# returns None while it's still being checked, unless wait is set (for small files)
+def process_upload(upload_root, upload_id, filename, wait=False):
+    touch_upload(upload_root, upload_id)
+    record = load_record(upload_root, upload_id, filename)
+    if record is not None:
+        return record
+    path = os.path.join(upload_root, upload_id, filename)
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        return {'hash': None, 'size': None, 'mtime': None, 'error': 'upload is gone (%s)' % e.strerror, 'warnings': []}
+    key = (path, stat.st_size, stat.st_mtime_ns)  # a check of contents replaced since isn't reused
+    with _uploads_lock:
+        future = _upload_futures.get(key)
+    if future is None:
+        future = get_upload_pool().submit(check_upload, upload_root, upload_id, filename)
+        with _uploads_lock:
+            future = _upload_futures.setdefault(key, future)
+    if not wait and not future.done():
+        return None
+    with _uploads_lock:
+        _upload_futures.pop(key, None)  # the saved record takes over
+    return future.result()
+
+
+# delete uploads unused for UPLOAD_TTL_S and the blobs only they used, and expired cache entries (CACHE_SWEEP_DIRS)
+def sweep(upload_root, ttl_s=UPLOAD_TTL_S):
+    expired_before = time.time() - ttl_s
+    with storage_lock(upload_root):
+        for name in list_uploads(upload_root):
+            if os.path.getmtime(os.path.join(upload_root, name)) >= expired_before:
+                break  # the rest were used more recently
+            remove_upload(upload_root, name, 'expired')
+        collect_blobs(upload_root)
+    for cache_root in CACHE_SWEEP_DIRS:
+        sweep_cache(cache_root, expired_before)
+
+
+# delete the entries (files or directories, by mtime) of a cache directory not used since expired_before
+def sweep_cache(cache_root, expired_before):
+    for name in os.listdir(cache_root) if os.path.isdir(cache_root) else []:
+        path = os.path.join(cache_root, name)
+        try:
+            if os.path.getmtime(path) >= expired_before:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:  # removed or used in the meantime
+            continue
+        logger.info("removed expired cache entry %s" % path)
+
+
+# background thread sweeping the upload root every SWEEP_INTERVAL_S, started on first use of the storage so
+# nothing runs before workers are forked (--preload); every server process runs one, they take turns on the lock
+def start_sweeper(upload_root):
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=run_sweeper, args=(upload_root,), name='upload-sweeper', daemon=True)
+            _sweeper.start()
+
+
+def run_sweeper(upload_root):
+    while True:
+        try:
+            sweep(upload_root)
+        except Exception as e:  # keep sweeping, a failed sweep is retried next interval
+            logger.warning("sweeping %s failed (%s: %s)" % (upload_root, type(e).__name__, e))
+        time.sleep(SWEEP_INTERVAL_S)
+
+
+# threads don't survive a fork, so a child starts its own sweeper and pool on first use (an upload check still in
+# flight in the parent is run again)
+def reset_threads():
+    global _sweeper, _sweeper_lock, _upload_pool, _upload_futures, _uploads_lock
+    _sweeper, _sweeper_lock = None, threading.Lock()
+    _upload_pool, _upload_futures, _uploads_lock = None, {}, threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_threads)
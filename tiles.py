@@ -0,0 +1,103 @@
+import json
+import math
+import os
+import numpy as np
+from PIL import Image
+
+TILE_SIZE = 256  # edge length of each tile in px (at its own pyramid level)
+DISPLAY_PX = 1024  # on-screen graph width in device px assumed until the browser has measured it
+TILE_META = 'meta.json'
+
+
+# read pyramid metadata (None if the pyramid hasn't been built yet)
+def load_meta(tile_dir):
+    try:
+        with open(os.path.join(tile_dir, TILE_META), mode='r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# halve resolution of 2D uint8 image by 2x2 block mean (odd edges are padded by repetition)
+def downsample(img_arr):
+    pad_rows, pad_cols = img_arr.shape[0] % 2, img_arr.shape[1] % 2
+    if pad_rows or pad_cols:
+        img_arr = np.pad(img_arr, ((0, pad_rows), (0, pad_cols)), mode='edge')
+    h, w = img_arr.shape
+    blocks = img_arr.reshape(h // 2, 2, w // 2, 2).sum(axis=(1, 3), dtype=np.uint16)
+    return ((blocks + 2) // 4).astype(np.uint8)
+
+
+# write multi-resolution PNG tiles for 2D uint8 image (level 0 is full resolution, each level halves it)
+# tiles are flipped vertically so they display with origin at the lower left like the micrograph axes
+# progress (optional) is called with the approximate fraction of tiles written after each level
+# for an image binned by bin_factor, shape is the original micrograph shape (tiles are placed in original px)
+def build_pyramid(img_arr, tile_dir, progress=None, bin_factor=1, shape=None):
+    level_arr = img_arr
+    level_shapes = []
+    while True:
+        level_dir = os.path.join(tile_dir, str(len(level_shapes)))
+        os.makedirs(level_dir, exist_ok=True)
+        for row in range(0, level_arr.shape[0], TILE_SIZE):
+            for col in range(0, level_arr.shape[1], TILE_SIZE):
+                tile = np.flipud(level_arr[row:row + TILE_SIZE, col:col + TILE_SIZE])
+                Image.fromarray(tile).save(os.path.join(level_dir, '%s_%s.png' % (col // TILE_SIZE,
+                                                                                    row // TILE_SIZE)))
+        level_shapes.append(list(level_arr.shape))
+        if progress is not None:
+            progress(1 - 0.25 ** len(level_shapes))  # each level has a quarter of the previous level's tiles
+        if max(level_arr.shape) <= TILE_SIZE:
+            break
+        level_arr = downsample(level_arr)
+
+    meta = {'shape': list(shape or img_arr.shape), 'tile_size': TILE_SIZE, 'level_shapes': level_shapes,
+            'bin': bin_factor}
+    tmp_path = os.path.join(tile_dir, TILE_META + '.tmp')
+    with open(tmp_path, mode='w') as f:  # metadata is written last and marks the pyramid as complete
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(tile_dir, TILE_META))
+    return meta
+
+
+# choose the coarsest pyramid level that still has about one tile px per screen px for the visible width
+def choose_level(meta, visible_px, display_px=DISPLAY_PX):
+    level = int(math.floor(math.log2(max(visible_px / (display_px * meta.get('bin', 1)), 1))))
+    return min(level, len(meta['level_shapes']) - 1)
+
+
+# make layout.images entries for one pyramid level covering the given ranges (in original px)
+def make_level_images(meta, tile_url, level, x_range, y_range):
+    scale = 2 ** level * meta.get('bin', 1)
+    tile_size = meta['tile_size']
+    level_h, level_w = meta['level_shapes'][level]
+    col0 = max(int((x_range[0] + 0.5) // (tile_size * scale)), 0)
+    col1 = min(int(math.ceil((x_range[1] + 0.5) / (tile_size * scale))), int(math.ceil(level_w / tile_size)))
+    row0 = max(int((y_range[0] + 0.5) // (tile_size * scale)), 0)
+    row1 = min(int(math.ceil((y_range[1] + 0.5) / (tile_size * scale))), int(math.ceil(level_h / tile_size)))
+
+    images = []
+    for row in range(row0, row1):
+        for col in range(col0, col1):
+            images.append(dict(source='%s/%s/%s_%s.png' % (tile_url, level, col, row), xref='x', yref='y',
+                               x=col * tile_size * scale - 0.5, y=min((row + 1) * tile_size, level_h) * scale - 0.5,
+                               sizex=min(tile_size, level_w - col * tile_size) * scale,
+                               sizey=min(tile_size, level_h - row * tile_size) * scale,
+                               xanchor='left', yanchor='top', sizing='stretch', layer='below'))
+    return images
+
+
+# make layout.images for the tiles visible in viewport ((x range, y range) in original px, None for full extent)
+# the coarsest level is always included underneath so the view is never blank while finer tiles load
+# display_px is the measured graph width in device px (None if unknown)
+def viewport_images(micrograph, viewport=None, display_px=None):
+    h, w = micrograph['shape']
+    x_range, y_range = viewport if viewport is not None else (None, None)
+    x_range = sorted(x_range) if x_range is not None else [-0.5, w - 0.5]
+    y_range = sorted(y_range) if y_range is not None else [-0.5, h - 0.5]
+    top_level = len(micrograph['level_shapes']) - 1
+    level = choose_level(micrograph, max(x_range[1] - x_range[0], y_range[1] - y_range[0]), display_px or DISPLAY_PX)
+
+    images = make_level_images(micrograph, micrograph['tile_url'], top_level, [-0.5, w - 0.5], [-0.5, h - 0.5])
+    if level != top_level:
+        images.extend(make_level_images(micrograph, micrograph['tile_url'], level, x_range, y_range))
+    return images
@@ -1,136 +1,471 @@
-from matplotlib import pyplot as plt
 import numpy as np
+import mrcfile
 import os
 import re
+import threading
 import pandas as pd
 import plotly.graph_objects as go
-from io import StringIO
+import hashlib
+import base64
+import json
+import logging
+import warnings
+import contrast
+import metrics
 
 BOX_COLORS = ['#ff7f00', '#4daf4a', '#f781bf', '#a65628', '#984ea3', '#e41a1c', '#dede00', '#377eb8']
 BOX_COLOR_NAMES = ['orange', 'green', 'pink', 'brown', 'violet', 'crimson', 'lime', 'steel blue']
 NO_CONF_VAL = -1.0
+PARSE_BLOCK_ROWS = 16384  # coordinate file rows converted to column arrays at a time
+HASH_CHUNK_BYTES = 2 ** 23
+STAR_INDEX_ROOT = os.path.join('cache', 'star-index')  # STAR files may be on read-only dataset mounts
+RANK_SEED = 0  # seeds the sampling ranks given to boxes at parse time, so "show N%" picks the same boxes every time
+RANK_STRATUM = 64  # boxes of similar confidence whose ranks are spread evenly over [0, 1)
+STACK_CHUNK_FRAMES = 8  # stack frames/volume slices read at a time when summing
+STACK_MODES = {'frame': 'Single frame', 'mean': 'Average of frames', 'sum': 'Sum of frames'}
+BOX_COLUMNS = {'.box': ['x', 'y', 'w', 'h'], '.cbox': ['x', 'y', 'w', 'h', 'conf'], '.coord': ['x', 'y']}
+STAR_COLUMNS = {'_rlnCoordinateX': 'x', '_rlnCoordinateY': 'y', '_rlnFigureOfMerit': 'conf',  # RELION
+                '_rlnMicrographName': 'micrograph',
+                '_CoordinateX': 'x', '_CoordinateY': 'y', '_Width': 'w', '_Height': 'h', '_Confidence': 'conf'}  # crYOLO
+# comparisons in DataTable filter queries, by symbol and by the name the table uses for it ('contains' on a
+# numeric column compares for equality)
+TABLE_FILTER_OPS = {'>=': np.greater_equal, 'ge': np.greater_equal, '<=': np.less_equal, 'le': np.less_equal,
+                    '!=': np.not_equal, 'ne': np.not_equal, '=': np.equal, 'eq': np.equal, 'contains': np.equal,
+                    '<': np.less, 'lt': np.less, '>': np.greater, 'gt': np.greater}
+TABLE_FILTER_RE = re.compile(r'^\s*\{(?P<col>[^}]+)\}\s*(?P<op>>=|<=|!=|=|<|>|[a-z]+)\s*(?P<value>.+?)\s*$',
+                             re.IGNORECASE)
 
+logger = logging.getLogger(__name__)
 
+_hashes = {}  # {(path, size, mtime): content hash} of files hashed by this process
+_hashes_lock = threading.Lock()
+
+
+@metrics.instrument
 def get_color(i):
     idx = int(i) % len(BOX_COLORS)
     return BOX_COLORS[idx], BOX_COLOR_NAMES[idx]
 
 
-# perform histogram equalization on 2D image array
+# open mrc file as a memory map (only the header is read up front, pixel data is paged in on access)
+@metrics.instrument
+def open_mrc(path):
+    return mrcfile.mmap(path, mode='r', permissive=True)
+
+
+# get 2D section of a memory-mapped mrc (first section for stacks/volumes) without reading pixel data
+@metrics.instrument
+def get_section(mrc, index=0):
+    if mrc.data.ndim == 3:
+        return mrc.data[index]
+    return mrc.data
+
+
+# number of frames/slices in a memory-mapped mrc (1 for a single micrograph)
+@metrics.instrument
+def get_n_sections(mrc):
+    return mrc.data.shape[0] if mrc.data.ndim == 3 else 1
+
+
+# sum (or mean) of sections first..last (inclusive) of a memory-mapped stack/volume as a float32 image,
+# reading STACK_CHUNK_FRAMES sections at a time so the whole stack is never in memory
+@metrics.instrument
+def sum_sections(mrc, first, last, average=False, progress=None):
+    if mrc.data.ndim != 3:
+        return np.array(mrc.data, dtype=np.float32)
+    total = np.zeros(mrc.data.shape[1:], dtype=np.float32)
+    for start in range(first, last + 1, STACK_CHUNK_FRAMES):
+        stop = min(start + STACK_CHUNK_FRAMES, last + 1)
+        total += mrc.data[start:stop].sum(axis=0, dtype=np.float32)
+        if progress is not None:
+            progress((stop - first) / (last + 1 - first))
+    if average:
+        total /= last + 1 - first
+    return total
+
+
+# 2D image to display for a stack/volume: one section ('frame' mode), or the sum/mean over a range of sections
+@metrics.instrument
+def get_stack_image(mrc, mode='frame', frames=(0, 0), progress=None):
+    n = get_n_sections(mrc)
+    first, last = sorted(min(max(int(f), 0), n - 1) for f in frames)
+    if mode == 'frame':
+        return get_section(mrc, first)
+    return sum_sections(mrc, first, last, average=mode == 'mean', progress=progress)
+
+
+# perform histogram equalization on 2D image array (returns uint8 array)
+@metrics.instrument
 def hist_equalize(img_arr):
-    hist_fig = plt.figure()
-    hist_arr, bins, _ = plt.hist(img_arr.ravel(), bins='auto', density=True)
-    cdf = hist_arr.cumsum()  # cumulative distribution function
-    cdf = 255 * cdf / cdf[-1]  # normalize
-    plt.close(hist_fig)
-    img_equalized = np.interp(img_arr.ravel(), bins[:-1], cdf)
-    return np.array(img_equalized.reshape(img_arr.shape))
+    return contrast.equalize(img_arr)
 
 
 # make rect for dcc.Graph figure given box data (assume x, y are at center of box)
+@metrics.instrument
 def make_rect(x, y, w, h, c, vis=True):
     return dict(type='rect', line=dict(color=c, width=1.5), xsizemode='scaled', ysizemode='scaled',
                 xref='x', yref='y', x0=x-w/2, y0=y-h/2, x1=x+w/2, y1=y+h/2, visible=vis)
 
 
-# make scatter trace for given df (boxfile)
-def make_trace(df, color, filename, filehash):
-    x = []
-    y = []
-    data = []
-    for i, row in df.iterrows():
-        x0 = row['x'] - row['w'] / 2
-        x1 = row['x'] + row['w'] / 2
-        y0 = row['y'] - row['h'] / 2
-        y1 = row['y'] + row['h'] / 2
-        x.extend([x0, x1, x1, x0, x0, None])  # have to bring the trace around to original point
-        y.extend([y0, y0, y1, y1, y0, None])  # None terminates each box
-        data.append((row['x'], row['y'], row['conf']))
-
-    if len(x) == 0 or len(y) == 0:
+# make scatter traces for given df (boxfile): box outlines and invisible center markers for hover info
+# outlines are built as one interleaved array per axis, with NaN (null in JSON) ending each box
+# (keep_empty makes empty traces for an empty df, to be filled in the browser later)
+@metrics.instrument
+def make_trace(df, color, filename, filehash, keep_empty=False):
+    if len(df.index) == 0 and not keep_empty:
         return []
 
-    if x[-1] is None:
-        del x[-1]
-    if y[-1] is None:
-        del y[-1]
+    x = df['x'].to_numpy(dtype=np.float64)
+    y = df['y'].to_numpy(dtype=np.float64)
+    half_w = df['w'].to_numpy(dtype=np.float64) / 2
+    half_h = df['h'].to_numpy(dtype=np.float64) / 2
+    x0, x1 = x - half_w, x + half_w
+    y0, y1 = y - half_h, y + half_h
+    gap = np.full(len(x), np.nan)
+    outline_x = np.column_stack([x0, x1, x1, x0, x0, gap]).ravel()[:-1]  # bring the trace around to original point
+    outline_y = np.column_stack([y0, y0, y1, y1, y0, gap]).ravel()[:-1]
+    customdata = np.column_stack([x, y, df['conf'].to_numpy(dtype=np.float64)])
 
-    return [go.Scattergl(x=x, y=y, mode='lines', line={'color': color}, name=filename, legendgroup=filehash,
-                         showlegend=True, hoverinfo='none'),
-            go.Scattergl(x=list(zip(*data))[0], y=list(zip(*data))[1], mode='markers', marker={'color': color},
-                         opacity=0, name=filename, legendgroup=filehash, showlegend=False, customdata=data,
+    return [go.Scattergl(x=outline_x, y=outline_y, mode='lines', line={'color': color}, name=filename,
+                         legendgroup=filehash, showlegend=True, hoverinfo='none'),
+            go.Scattergl(x=x, y=y, mode='markers', marker={'color': color},
+                         opacity=0, name=filename, legendgroup=filehash, showlegend=False, customdata=customdata,
                          hovertemplate='<b>confidence</b>: %{customdata[2]:.2f}' +
                                        '<br>center-x: %{customdata[0]:.2f}' +
                                        '<br>center-y: %{customdata[1]:.2f}')]
 
 
+# boxes with confidence in conf_range (percent) of a table sorted by confidence (see make_box_table), of which
+# box_percent are kept by thresholding their sampling rank; the confidence range is found by binary search and
+# boxes without confidence (NO_CONF_VAL sorts first) are a prefix of the table
+@metrics.instrument
 def filter_df(df, box_percent, conf_range, keep_no_conf=True):
-    conf_low = conf_range[0] / 100
-    conf_high = conf_range[1] / 100
-    if keep_no_conf:
-        boxes = df.loc[((df['conf'] >= conf_low) & (df['conf'] <= conf_high)) | (df['conf'] == -1)]
+    conf = df['conf'].to_numpy()
+    low = np.searchsorted(conf, conf_range[0] / 100, side='left')
+    high = np.searchsorted(conf, conf_range[1] / 100, side='right')
+    n_no_conf = np.searchsorted(conf, NO_CONF_VAL, side='right') if keep_no_conf else 0
+    if n_no_conf == 0:
+        boxes = df.iloc[low:high]
     else:
-        boxes = df.loc[(df['conf'] >= conf_low) & (df['conf'] <= conf_high)]
-    boxes = boxes.sample(frac=box_percent / 100)
-    print("BOXES")
-    print(boxes)
+        boxes = df.iloc[np.r_[0:n_no_conf, max(low, n_no_conf):high]]
+    if box_percent < 100:
+        boxes = boxes[boxes['rank'].to_numpy() < box_percent / 100]
     return boxes
 
 
-# read boxfile given filename, adjusting x, y to center of box if needed
-def parse_boxfile(file_str, filename, manual_boxsize):
-    ext = os.path.splitext(filename)[-1].lower()
+# columns of a coordinate table as base64-encoded little-endian float32 arrays (float64 for confidences), the
+# compact form overlays are shipped in for filtering in the browser (assets/overlays.js)
+@metrics.instrument
+def encode_overlay(df):
+    dtypes = dict.fromkeys(['x', 'y', 'w', 'h', 'rank'], '<f4')
+    dtypes['conf'] = '<f8'  # filter_df's confidence bounds cut at float64 values, which float32 would round
+    return {col: base64.b64encode(df[col].to_numpy().astype(dtype).tobytes()).decode('ascii')
+            for col, dtype in dtypes.items()}
 
-    # remove non-numeric lines
-    no_header_file = ""
-    star_header = {}
-    for line in file_str.splitlines():
-        if ext in ['.star'] and line.startswith('_') and '#' in line:
-            split_line = ''.join(line.split()).split('#')
-            star_header[split_line[0]] = split_line[1]
+
+# random sampling ranks in [0, 1) for n boxes in ascending confidence order: each run of RANK_STRATUM boxes gets
+# evenly spread ranks in random order, so any rank threshold keeps about the same share of every confidence level
+@metrics.instrument
+def get_sample_ranks(n, seed=RANK_SEED, stratum=RANK_STRATUM):
+    rng = np.random.default_rng(seed)
+    n_full = n // stratum * stratum
+    position = np.empty(n, dtype=np.float32)
+    position[:n_full] = rng.random((n // stratum, stratum)).argsort(axis=1).ravel()  # a permutation per stratum
+    position[n_full:] = rng.permutation(n - n_full)
+    stratum_size = np.full(n, stratum, dtype=np.float32)
+    stratum_size[n_full:] = n - n_full
+    return (position + rng.random(n, dtype=np.float32)) / stratum_size
+
+
+# boolean mask of table rows matching a DataTable filter query ('{x} > 100 && {conf} ge 0.5'), evaluated one
+# vectorized comparison per clause (clauses that don't parse or name unknown columns are ignored)
+@metrics.instrument
+def filter_table_mask(df, filter_query):
+    mask = np.ones(len(df.index), dtype=bool)
+    for clause in (filter_query or '').split(' && '):
+        match = TABLE_FILTER_RE.match(clause)
+        if match is None or match.group('col') not in df.columns or match.group('op').lower() not in TABLE_FILTER_OPS:
             continue
-        elif re.search('[0-9]', line) is None:
+        try:
+            value = float(match.group('value').strip('"\'`'))
+        except ValueError:
             continue
-        elif star_header:  # if we're past the header
-            no_header_file = no_header_file + line + os.linesep
-
-    str_buffer = StringIO(no_header_file)
-    df = pd.read_csv(str_buffer, delim_whitespace=True, skipinitialspace=True, skip_blank_lines=True, header=None)
-    print("INFO: using manual boxsize %s for file %s" % (manual_boxsize, filename))
-
-    if ext in ['.box']:
-        df = df.rename(columns={0: 'x', 1: 'y', 2: 'w', 3: 'h'})
-        df['x'] = df['x'] + (df['w'] / 2)
-        df['y'] = df['y'] + (df['h'] / 2)
-        df['conf'] = [NO_CONF_VAL] * len(df.index)
-
-    elif ext in ['.cbox']:
-        df = df.rename(columns={0: 'x', 1: 'y', 2: 'w', 3: 'h', 4: 'conf'})
-        df['x'] = df['x'] + (df['w'] / 2)
-        df['y'] = df['y'] + (df['h'] / 2)
-
-    elif ext in ['.star']:
-        if manual_boxsize is None or manual_boxsize == "":
-            return None
-        supported_cols = ['_rlnCoordinateX', '_rlnCoordinateY', '_rlnFigureOfMerit']  # [:2] required, [2] is optional
-        if not all(k in star_header for k in supported_cols[:2]):
-            print("ERROR: Could not find x/y STAR header columns.")
-        filtered_star_header = {k: v for k, v in star_header.items() if k in supported_cols}
-        filtered_star_header['x'] = filtered_star_header.pop(supported_cols[0])
-        filtered_star_header['y'] = filtered_star_header.pop(supported_cols[1])
-        if supported_cols[2] in filtered_star_header:
-            filtered_star_header['conf'] = filtered_star_header.pop(supported_cols[2])
-        df = df.rename(columns={int(v) - 1: k for k, v in filtered_star_header.items()})
-        df['w'] = df['h'] = [manual_boxsize] * len(df.index)
-        if supported_cols[2] not in filtered_star_header:
-            df['conf'] = [NO_CONF_VAL] * len(df.index)  # do this after required columns are assigned
-
-    elif ext in ['.coord']:
-        if manual_boxsize is None or manual_boxsize == "":
+        mask &= TABLE_FILTER_OPS[match.group('op').lower()](df[match.group('col')].to_numpy(), value)
+    return mask
+
+
+# row positions of a coordinate table after a DataTable filter query and sort_by (list of column_id/direction)
+@metrics.instrument
+def query_table(df, filter_query, sort_by):
+    rows = np.flatnonzero(filter_table_mask(df, filter_query))
+    sort_by = [s for s in sort_by or [] if s['column_id'] in df.columns]
+    if sort_by:
+        # np.lexsort sorts by its last key first and is stable, descending columns are negated
+        keys = [df[s['column_id']].to_numpy()[rows] * (-1 if s['direction'] == 'desc' else 1)
+                for s in reversed(sort_by)]
+        rows = rows[np.lexsort(keys)]
+    return rows
+
+
+# BLAKE2b content hash (hex) of a file, streamed through one reused buffer (hashlib releases the GIL, so files
+# hashed from different threads are hashed in parallel); cached by path, size and mtime
+@metrics.instrument
+def hash_file(path):
+    stat = os.stat(path)
+    cache_key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        if cache_key in _hashes:
+            return _hashes[cache_key]
+
+    hashed = hashlib.blake2b(digest_size=16)
+    buf = bytearray(HASH_CHUNK_BYTES)
+    view = memoryview(buf)
+    with open(path, mode='rb') as f:
+        for n in iter(lambda: f.readinto(buf), 0):
+            hashed.update(view[:n])
+    with _hashes_lock:
+        _hashes[cache_key] = hashed.hexdigest()
+    return _hashes[cache_key]
+
+
+# check that an mrc file opens and its data block matches the header, without reading pixel data
+# returns (error or None, warnings from mrcfile's checks of map ID, machine stamp, mode and file size)
+@metrics.instrument
+def check_mrc(path):
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        try:
+            with open_mrc(path) as mrc:
+                error = None if mrc.data is not None else 'data is shorter than the header says'
+        except (OSError, ValueError) as e:
+            error = str(e)
+    return error, [str(w.message) for w in caught]
+
+
+# convert buffered whitespace-separated rows (bytes) into float64 arrays for wanted columns ({name: index})
+@metrics.instrument
+def rows_to_columns(rows, wanted):
+    n_cols = len(rows[0].split())
+    tokens = b' '.join(rows).split()
+    if len(tokens) == n_cols * len(rows) and max(wanted.values()) < n_cols:  # rectangular block: slice columns
+        return {name: np.array(tokens[i::n_cols]).astype(np.float64) for name, i in wanted.items()}
+    split_rows = [row.split() for row in rows]  # ragged block: split row by row, dropping short rows
+    split_rows = [row for row in split_rows if len(row) > max(wanted.values())]
+    return {name: np.array([row[i] for row in split_rows], dtype=bytes).astype(np.float64)
+            for name, i in wanted.items()}
+
+
+# walk coordinate file (binary file object) once, yielding ('loop', header, span) when the first data row of a
+# STAR loop (header is {column name: index}) or of a file without STAR loops (header is None) is reached,
+# and ('row', stripped line, span) for every data row, where span is the line's (start, end) byte offsets
+# (not instrumented, as a generator its time is spent in the caller)
+def iter_boxfile(file):
+    header = {}
+    n_labels = 0
+    in_loop = False
+    started = False
+    offset = 0
+    for raw_line in file:
+        span = (offset, offset + len(raw_line))
+        offset = span[1]
+        line = raw_line.strip()
+        if not line or line.startswith(b'#'):
+            continue
+        elif line.startswith(b'data_') or line.startswith(b'loop_'):
+            header = {}
+            n_labels = 0
+            in_loop = line.startswith(b'loop_')
+            started = False
+        elif line.startswith(b'_'):
+            if not in_loop:  # key/value pair outside of a loop
+                continue
+            if started:  # labels after rows can only belong to a new (implicit) loop
+                header = {}
+                n_labels = 0
+                started = False
+            split_line = line.split()
+            index = int(split_line[1].lstrip(b'#')) - 1 if len(split_line) > 1 else n_labels
+            n_labels += 1
+            label = split_line[0].decode('utf-8', 'replace')
+            if label in STAR_COLUMNS:
+                header[STAR_COLUMNS[label]] = index
+        elif in_loop or re.search(b'[0-9]', line) is not None:
+            if not started:
+                yield 'loop', header if in_loop else None, span
+                started = True
+            yield 'row', line, span
+
+
+# numeric columns to read from rows, by STAR loop header or by position for plain whitespace-separated formats
+@metrics.instrument
+def get_wanted_columns(header, ext, first_row):
+    if header is not None:
+        return {name: i for name, i in header.items() if name in BOX_COLUMNS['.cbox']}
+    n_cols = len(first_row.split())
+    return {name: i for i, name in enumerate(BOX_COLUMNS.get(ext, BOX_COLUMNS['.box'])) if i < n_cols}
+
+
+# turn column arrays read from a coordinate file into a box table, adjusting x, y to center of box if needed
+@metrics.instrument
+def make_box_table(columns, filename, manual_boxsize):
+    ext = os.path.splitext(filename)[-1].lower()
+    has_boxsize = manual_boxsize is not None and manual_boxsize != ""
+    if 'x' not in columns or 'y' not in columns:
+        logger.error("could not find x/y columns in %s" % filename)
+        return None
+    columns = {name: np.concatenate(arrs) for name, arrs in columns.items()}
+    n_boxes = len(columns['x'])
+    logger.debug("using manual boxsize %s for file %s" % (manual_boxsize, filename))
+
+    if ext in ['.star', '.coord'] or 'w' not in columns or 'h' not in columns:
+        if not has_boxsize:
             return None
-        df = df.rename(columns={0: 'x', 1: 'y'})
-        df['w'] = df['h'] = [manual_boxsize] * len(df.index)
-        df['conf'] = [NO_CONF_VAL] * len(df.index)
+        columns['w'] = np.full(n_boxes, float(manual_boxsize))
+        columns['h'] = np.full(n_boxes, float(manual_boxsize))
+    elif ext in ['.box', '.cbox']:  # box files give the lower left corner
+        columns['x'] = columns['x'] + columns['w'] / 2
+        columns['y'] = columns['y'] + columns['h'] / 2
+    if 'conf' not in columns:
+        columns['conf'] = np.full(n_boxes, NO_CONF_VAL)
+
+    # rows are kept in ascending confidence order and given sampling ranks (see filter_df)
+    order = np.argsort(columns['conf'], kind='stable')
+    table = pd.DataFrame({name: columns[name][order] for name in BOX_COLUMNS['.cbox']})
+    table['rank'] = get_sample_ranks(n_boxes)
+    return table
+
+
+# read boxfile (path or binary file object) given filename, adjusting x, y to center of box if needed
+# the file is streamed once and data rows are converted a block at a time straight into typed column arrays,
+# so only the columns we need are ever held in memory
+@metrics.instrument
+def parse_boxfile(file, filename, manual_boxsize):
+    ext = os.path.splitext(filename)[-1].lower()
+    if ext in ['.star', '.coord'] and (manual_boxsize is None or manual_boxsize == ""):
+        return None
+    if not hasattr(file, 'read'):
+        with open(file, mode='rb') as f:
+            return parse_boxfile(f, filename, manual_boxsize)
+
+    columns = {}
+    rows = []
+    header = None
+
+    def flush_rows():
+        wanted = get_wanted_columns(header, ext, rows[0]) if rows else {}
+        if 'x' in wanted and 'y' in wanted:  # skip loops without coordinates (e.g. optics groups)
+            for name, arr in rows_to_columns(rows, wanted).items():
+                columns.setdefault(name, []).append(arr)
+        rows.clear()
+
+    for kind, value, _ in iter_boxfile(file):
+        if kind == 'loop':
+            flush_rows()
+            header = value
+        else:
+            rows.append(value)
+            if len(rows) >= PARSE_BLOCK_ROWS:
+                flush_rows()
+    flush_rows()
+
+    return make_box_table(columns, filename, manual_boxsize)
+
+
+# build (or load the cached) per-micrograph index of a STAR file, stored under index_root by path (and used while
+# the file's size and mtime match, its own mtime marking when it was last used); if that can't be written it's
+# only returned
+# for every loop with coordinates and micrograph names it records the byte ranges holding each micrograph's rows
+# (keyed by micrograph file stem), so one micrograph's boxes can be read without parsing the rest of the file
+@metrics.instrument
+def index_star(path, index_root=STAR_INDEX_ROOT):
+    path_hash = hashlib.sha1(os.path.realpath(path).encode('utf-8')).hexdigest()
+    index_path = os.path.join(index_root, path_hash + '.json')
+    stat = os.stat(path)
+    try:
+        with open(index_path, mode='r') as f:
+            index = json.load(f)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime_ns:
+            os.utime(index_path)
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    logger.info("indexing micrographs in %s" % path)
+    loops = []
+    micrographs = {}
+    name_col = None
+    run = None  # [loop, start, end] of rows for the same micrograph
+    run_name = None
+
+    with open(path, mode='rb') as f:
+        for kind, value, span in iter_boxfile(f):
+            if kind == 'loop':
+                run = None
+                name_col = None
+                if value is not None and all(k in value for k in ['x', 'y', 'micrograph']):
+                    loops.append(value)
+                    name_col = value['micrograph']
+                continue
+            if name_col is None:
+                continue
+            fields = value.split()
+            if len(fields) <= name_col:  # short row, dropped when the micrograph's rows are parsed too
+                continue
+            name = fields[name_col]
+            if run is not None and name == run_name:
+                run[2] = span[1]
+                continue
+            run_name = name
+            run = [len(loops) - 1, span[0], span[1]]
+            stem = os.path.splitext(os.path.basename(name.decode('utf-8', 'replace')))[0]
+            micrographs.setdefault(stem, []).append(run)
+
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'loops': loops, 'micrographs': micrographs}
+    tmp_path = index_path + '.tmp%s-%s' % (os.getpid(), threading.get_ident())
+    try:
+        os.makedirs(index_root, exist_ok=True)
+        with open(tmp_path, mode='w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        logger.warning("could not save the index of %s (%s)" % (path, e))
+    return index
+
+
+# read the boxes of one micrograph (by file stem) from an indexed STAR file, seeking straight to its rows
+@metrics.instrument
+def read_star_micrograph(path, index, mic_stem, filename, manual_boxsize):
+    if manual_boxsize is None or manual_boxsize == "":
+        return None
+    columns = {}
+    with open(path, mode='rb') as f:
+        for loop, start, end in index['micrographs'].get(mic_stem, []):
+            f.seek(start)
+            rows = [row.strip() for row in f.read(end - start).splitlines()]
+            rows = [row for row in rows if row and not row.startswith(b'#')]
+            for name, arr in rows_to_columns(rows, get_wanted_columns(index['loops'][loop], '.star', None)).items():
+                columns.setdefault(name, []).append(arr)
+    if not columns:  # micrograph has no picks in this file
+        return pd.DataFrame({name: np.empty(0) for name in BOX_COLUMNS['.cbox'] + ['rank']})
+    return make_box_table(columns, filename, manual_boxsize)
 
-    return df
 
+# get visible (x range, y range) from graph relayoutData, with None for an axis that was autoscaled
+# returns None if relayoutData doesn't describe a zoom/pan at all (e.g. autosize or dragmode changes)
+@metrics.instrument
+def get_viewport(relayout_data):
+    if not relayout_data:
+        return None
+    viewport = []
+    changed = False
+    for axis in ['xaxis', 'yaxis']:
+        if axis + '.range[0]' in relayout_data and axis + '.range[1]' in relayout_data:
+            viewport.append([relayout_data[axis + '.range[0]'], relayout_data[axis + '.range[1]']])
+            changed = True
+        elif axis + '.range' in relayout_data:
+            viewport.append(list(relayout_data[axis + '.range']))
+            changed = True
+        else:
+            viewport.append(None)
+            changed = changed or axis + '.autorange' in relayout_data
+    return tuple(viewport) if changed else None